@@ -1,17 +1,445 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+import time
+# A partida é contada desde aqui: os imports (Flask, SQLAlchemy...) são a maior parte dela
+INICIO_IMPORTACAO = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, abort, stream_with_context, jsonify
+from flask import g, has_request_context, before_render_template, template_rendered
+from flask import make_response, send_from_directory, session, stream_template, appcontext_pushed
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateColumn, CreateIndex
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from werkzeug.exceptions import NotFound
 from werkzeug.security import generate_password_hash, check_password_hash
-import qrcode
+from markupsafe import Markup
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from functools import wraps
+from urllib.parse import urlsplit
+import click
+import estaticos
+import atexit
+import base64
+import codecs
+import csv
+import hashlib
+import io
+import json
+import mimetypes
+import multiprocessing
 import os
+import random
+import re
+import socket
+import sqlite3
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Opcional: sem o pacote as respostas saem só com gzip
+    brotli = None
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///inventario.db'
 app.config['SECRET_KEY'] = 'minha_chave_secreta'
-db = SQLAlchemy(app)
+# Paginação da listagem de materiais
+app.config['INVENTARIO_POR_PAGINA'] = 50
+app.config['INVENTARIO_POR_PAGINA_MAX'] = 500
+# QR Codes: endereço codificado, tamanho do cache em memória e forma de exibição
+# na listagem ('img' = uma requisição por QR, 'svg' = SVG embutido na página)
+app.config['QR_URL_BASE'] = 'http://192.168.0.100'
+app.config['QR_CACHE_MEMORIA'] = 2048
+app.config['QR_CACHE_MAX_AGE'] = 7 * 24 * 3600
+app.config['QR_LISTAGEM'] = 'img'
+# Importação/exportação em massa: linhas por lote (uma transação por lote)
+app.config['IMPORTACAO_LOTE'] = 5000
+app.config['EXPORTACAO_LOTE'] = 1000
+# Ações em lote da listagem: ids por instrução UPDATE/DELETE ... WHERE id IN (...)
+app.config['OPERACOES_LOTE'] = 500
+# Folhas de etiquetas: processos que desenham as páginas (0 = desenha no próprio worker).
+# O pool é de cada worker web: com N workers podem existir N * ETIQUETAS_PROCESSOS processos
+app.config['ETIQUETAS_PROCESSOS'] = 2
+app.config['ETIQUETAS_LAYOUT'] = {}
+# Busca textual: resultados por página
+app.config['BUSCA_POR_PAGINA'] = 50
+# Perfil do SQLite para produção (vários workers): aplicado em cada conexão nova
+app.config['SQLITE_PRAGMAS'] = {
+    'busy_timeout': 5000,          # ms esperando o lock antes de "database is locked"
+    'journal_mode': 'WAL',         # leitores não bloqueiam o escritor (e vice-versa)
+    'synchronous': 'NORMAL',       # seguro com WAL e bem mais rápido que FULL
+    'cache_size': -32000,          # ~32 MB de cache de páginas por conexão
+    'mmap_size': 268435456,        # 256 MB lidos via mmap
+    'temp_store': 'MEMORY',
+}
+app.config['SQLITE_POOL_SIZE'] = 10
+app.config['SQLITE_MAX_OVERFLOW'] = 10
+# Retentativas das transações de escrita quando o banco está ocupado
+app.config['SQLITE_RETENTATIVAS'] = 5
+app.config['SQLITE_RETENTATIVA_ESPERA'] = 0.05
+app.config['DEBUG'] = False
+# Usuários em cache por processo (segundos); aprovações/remoções invalidam na hora
+# no processo que as fez e, nos demais workers, em até USUARIO_CACHE_TTL
+app.config['USUARIO_CACHE_TTL'] = 60
+# Hash de senha: método/custo do werkzeug para senhas novas (as antigas continuam
+# válidas e são refeitas no próximo login), threads dedicadas e limite de
+# logins com senha errada e de registros por cliente dentro da janela (0 desliga).
+# O limite é contado em memória, por processo: com N workers do gunicorn o
+# cliente consegue até N * LOGIN_LIMITE tentativas por janela
+app.config['SENHA_METODO'] = 'scrypt:32768:8:1'
+app.config['SENHA_TRABALHADORES'] = 2
+app.config['LOGIN_LIMITE'] = 10
+app.config['LOGIN_JANELA'] = 60
+# Métricas por requisição (/metrics). Detector opcional de consultas repetidas (N+1):
+# avisa no log quando a mesma instrução roda mais que METRICAS_LIMITE_REPETICOES vezes
+# numa requisição (0 desliga). METRICAS_CONSULTA_LENTA em segundos (0 desliga).
+app.config['METRICAS_HABILITADAS'] = True
+app.config['METRICAS_LIMITE_REPETICOES'] = 0
+app.config['METRICAS_CONSULTA_LENTA'] = 0
+# Compressão gzip/brotli das respostas de texto: respostas prontas menores que
+# COMPRESSAO_MINIMO bytes vão sem compressão; as transmitidas em fluxo são
+# comprimidas em blocos de COMPRESSAO_BLOCO (brotli só se o pacote estiver instalado)
+app.config['COMPRESSAO_HABILITADA'] = True
+app.config['COMPRESSAO_MINIMO'] = 1024
+app.config['COMPRESSAO_BLOCO'] = 16384
+app.config['COMPRESSAO_NIVEL_GZIP'] = 6
+app.config['COMPRESSAO_NIVEL_BROTLI'] = 5
+# API JSON dos coletores: ids por consulta, operações por lote, materiais por
+# página do feed de alterações e dias guardando os ids de operação já aplicados
+app.config['API_IDS_MAX'] = 500
+app.config['API_OPERACOES_MAX'] = 500
+app.config['API_ALTERACOES_LIMITE'] = 1000
+app.config['API_OPERACOES_RETENCAO_DIAS'] = 30
+# Tarefas em segundo plano: 'processo' executa em threads dentro de cada worker
+# web; 'externo' deixa tudo para `flask trabalhador` rodando em outro processo.
+# Ociosa, cada thread consulta a fila (só leitura) a cada TAREFAS_INTERVALO;
+# o worker que enfileira acorda a sua na hora (executor_tarefas.avisar())
+app.config['TAREFAS_EXECUTOR'] = 'processo'
+app.config['TAREFAS_TRABALHADORES'] = 2
+app.config['TAREFAS_INTERVALO'] = 2            # segundos entre consultas à fila quando ociosa
+app.config['TAREFAS_ESPERA_BASE'] = 5          # segundos antes da 1ª retentativa (dobra a cada falha)
+app.config['TAREFAS_TEMPO_LIMITE'] = 3600      # 'executando' há mais tempo que isso volta para a fila
+app.config['TAREFAS_RETENCAO_DIAS'] = 7
+# Relatórios de consumo: janelas (dias) pré-calculadas para a taxa de consumo e a
+# padrão, prazo de reposição do fornecedor e dias de estoque de segurança nas
+# sugestões de alerta
+app.config['RELATORIO_JANELAS'] = [30, 90, 180, 365]
+app.config['RELATORIO_JANELA_DIAS'] = 90
+app.config['RELATORIO_PRAZO_REPOSICAO_DIAS'] = 15
+app.config['RELATORIO_DIAS_SEGURANCA'] = 7
+app.config['RELATORIO_LIMITE'] = 200
+# Inicialização: criar_app() avisa no log quando o import deste módulo somado a
+# criar_app() passar de INICIALIZACAO_LIMITE segundos (0 desliga). Não inclui a
+# subida do interpretador; benchmarks/inicializacao.py mede o processo inteiro
+app.config['INICIALIZACAO_LIMITE'] = 0.5
+# Pacotes CSS/JS/fontes com hash no nome (gerados por `flask estaticos`): cache no navegador
+app.config['ESTATICOS_MAX_AGE'] = 365 * 24 * 3600
+# Qualquer chave acima pode ser sobrescrita por variáveis INVENTARIO_<CHAVE>,
+# ex.: INVENTARIO_SQLALCHEMY_DATABASE_URI=sqlite:////dados/inventario.db
+app.config.from_prefixed_env('INVENTARIO')
+
+def opcoes_engine(uri):
+    if not uri.startswith('sqlite'):
+        return {}
+    opcoes = {'connect_args': {'timeout': app.config['SQLITE_PRAGMAS']['busy_timeout'] / 1000}}
+    # Bancos em memória usam um pool de conexão única, sem essas opções
+    if ':memory:' not in uri and uri.rstrip('/') != 'sqlite:':
+        opcoes['pool_size'] = app.config['SQLITE_POOL_SIZE']
+        opcoes['max_overflow'] = app.config['SQLITE_MAX_OVERFLOW']
+    return opcoes
+
+# As extensões só são ligadas ao app em criar_app()
+db = SQLAlchemy()
+
+@event.listens_for(Engine, 'connect')
+def aplicar_pragmas_sqlite(conexao_dbapi, registro):
+    if not isinstance(conexao_dbapi, sqlite3.Connection):
+        return
+    cursor = conexao_dbapi.cursor()
+    for nome, valor in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {nome} = {valor}')
+    cursor.close()
+
+def banco_ocupado(erro):
+    mensagem = str(erro.orig).lower()
+    return 'database is locked' in mensagem or 'database is busy' in mensagem
+
+def com_retentativa(funcao):
+    """Repete a transação de escrita quando o SQLite responde "database is locked".
+
+    Com WAL, uma transação que leu antes de escrever pode falhar na hora de
+    pegar o lock mesmo com busy_timeout; nesse caso desfazemos tudo e
+    tentamos de novo com espera exponencial. A função decorada precisa fazer
+    o próprio commit e não ter efeitos colaterais antes dele.
+    """
+    @wraps(funcao)
+    def envolvida(*args, **kwargs):
+        tentativas = app.config['SQLITE_RETENTATIVAS']
+        for tentativa in range(tentativas):
+            try:
+                return funcao(*args, **kwargs)
+            except OperationalError as erro:
+                db.session.rollback()
+                if not banco_ocupado(erro) or tentativa == tentativas - 1:
+                    raise
+                espera = app.config['SQLITE_RETENTATIVA_ESPERA'] * (2 ** tentativa)
+                time.sleep(espera * (1 + random.random()))
+    return envolvida
+
+# ===================================
+# Instrumentação: métricas por requisição no formato do Prometheus
+# ===================================
+
+class Metricas:
+    """Contadores e histogramas em memória (por processo) com exportação em texto.
+
+    Cada série sai com o rótulo worker (pid do processo): duas respostas de
+    /metrics vindas de workers diferentes não se confundem num contador só
+    que sobe e desce.
+    """
+
+    BALDES = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contadores = defaultdict(lambda: defaultdict(float))
+        self.histogramas = defaultdict(dict)
+        self.ajuda = {}
+
+    def contar(self, nome, valor=1, ajuda='', **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self.lock:
+            self.ajuda.setdefault(nome, ('counter', ajuda))
+            self.contadores[nome][chave] += valor
+
+    def observar(self, nome, valor, ajuda='', **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self.lock:
+            self.ajuda.setdefault(nome, ('histogram', ajuda))
+            serie = self.histogramas[nome].setdefault(chave, [[0] * len(self.BALDES), 0.0, 0])
+            for indice, limite in enumerate(self.BALDES):
+                if valor <= limite:
+                    serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    @staticmethod
+    def rotulos(pares):
+        if not pares:
+            return ''
+        texto = ','.join(
+            '{}="{}"'.format(nome, str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for nome, valor in pares)
+        return '{' + texto + '}'
+
+    def exportar(self):
+        linhas = []
+        # Lido a cada exportação: com preload do gunicorn o pid muda depois do fork
+        worker = (('worker', str(os.getpid())),)
+        with self.lock:
+            for nome, (tipo, ajuda) in sorted(self.ajuda.items()):
+                linhas.append(f'# HELP {nome} {ajuda}')
+                linhas.append(f'# TYPE {nome} {tipo}')
+                if tipo == 'counter':
+                    for chave, valor in sorted(self.contadores[nome].items()):
+                        chave = worker + chave
+                        linhas.append(f'{nome}{self.rotulos(chave)} {valor:g}')
+                    continue
+                for chave, (baldes, soma, total) in sorted(self.histogramas[nome].items()):
+                    chave = worker + chave
+                    for limite, quantidade in zip(self.BALDES, baldes):
+                        linhas.append(f'{nome}_bucket{self.rotulos(chave + (("le", f"{limite:g}"),))} {quantidade}')
+                    linhas.append(f'{nome}_bucket{self.rotulos(chave + (("le", "+Inf"),))} {total}')
+                    linhas.append(f'{nome}_sum{self.rotulos(chave)} {soma:.6f}')
+                    linhas.append(f'{nome}_count{self.rotulos(chave)} {total}')
+        return '\n'.join(linhas) + '\n'
+
+metricas = Metricas()
+
+def medicao_atual():
+    if not has_request_context():
+        return None
+    return g.get('medicao')
+
+def medir_tempo(etapa, ajuda=''):
+    """Cronometra a função no histograma inventario_<etapa>_segundos e na requisição atual."""
+    def decorador(funcao):
+        @wraps(funcao)
+        def medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                duracao = time.perf_counter() - inicio
+                metricas.observar(f'inventario_{etapa}_segundos', duracao, ajuda)
+                medicao = medicao_atual()
+                if medicao is not None:
+                    medicao[etapa] += duracao
+        return medida
+    return decorador
+
+# ===================================
+# Senhas: hash num pool limitado de threads e limite de tentativas por cliente
+# ===================================
+
+# O scrypt/pbkdf2 do hashlib libera o GIL; com o pool, no máximo
+# SENHA_TRABALHADORES hashes rodam ao mesmo tempo e uma rajada de logins
+# espera na fila em vez de tomar a CPU das demais requisições
+pool_hash_senha = None
+pool_hash_senha_lock = threading.Lock()
+
+def obter_pool_hash_senha():
+    global pool_hash_senha
+    with pool_hash_senha_lock:
+        if pool_hash_senha is None:
+            pool_hash_senha = ThreadPoolExecutor(max_workers=app.config['SENHA_TRABALHADORES'],
+                                                 thread_name_prefix='hash-senha')
+        return pool_hash_senha
+
+@medir_tempo('hash_senha', 'Tempo gasto gerando e verificando hashes de senha.')
+def verificar_hash_senha(password_hash, senha):
+    return obter_pool_hash_senha().submit(check_password_hash, password_hash, senha).result()
+
+@medir_tempo('hash_senha')
+def gerar_hash_senha(senha):
+    return obter_pool_hash_senha().submit(generate_password_hash, senha, app.config['SENHA_METODO']).result()
+
+class LimiteTentativas:
+    """Janela deslizante de tentativas por chave (ex.: IP do cliente).
+
+    Fica na memória do processo: cada worker conta as suas tentativas.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tentativas = defaultdict(deque)
+
+    def permitir(self, chave, limite, janela):
+        """Só consulta; a tentativa entra na conta com registrar()."""
+        if not limite:
+            return True
+        agora = time.monotonic()
+        with self.lock:
+            fila = self.tentativas.get(chave)
+            while fila and fila[0] <= agora - janela:
+                fila.popleft()
+            return not fila or len(fila) < limite
+
+    def registrar(self, chave, janela):
+        agora = time.monotonic()
+        with self.lock:
+            self.tentativas[chave].append(agora)
+            # Descarta chaves ociosas para o dicionário não crescer sem limite
+            if len(self.tentativas) > 10000:
+                for antiga in [c for c, f in self.tentativas.items() if not f or f[-1] <= agora - janela]:
+                    del self.tentativas[antiga]
+
+limite_login = LimiteTentativas()
+
+def tentativa_permitida():
+    return limite_login.permitir(request.remote_addr, app.config['LOGIN_LIMITE'], app.config['LOGIN_JANELA'])
+
+def registrar_tentativa():
+    # Chamado nos logins com senha errada e nos registros: logins certos não contam
+    if app.config['LOGIN_LIMITE']:
+        limite_login.registrar(request.remote_addr, app.config['LOGIN_JANELA'])
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def iniciar_cronometro_sql(conexao, cursor, instrucao, parametros, contexto, executemany):
+    conexao.info.setdefault('inicio_sql', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def registrar_tempo_sql(conexao, cursor, instrucao, parametros, contexto, executemany):
+    duracao = time.perf_counter() - conexao.info['inicio_sql'].pop()
+    medicao = medicao_atual()
+    if medicao is None:
+        return
+    medicao['sql'] += duracao
+    medicao['sql_instrucoes'] += 1
+    if app.config['METRICAS_LIMITE_REPETICOES']:
+        medicao['repeticoes'][instrucao] += 1
+    limite_lenta = app.config['METRICAS_CONSULTA_LENTA']
+    if limite_lenta and duracao > limite_lenta:
+        app.logger.warning('Consulta lenta (%.3fs) em %s: %s', duracao, request.path, instrucao)
+
+@before_render_template.connect_via(app)
+def iniciar_cronometro_template(remetente, template, context, **extra):
+    medicao = medicao_atual()
+    if medicao is not None:
+        medicao['inicio_template'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def registrar_tempo_template(remetente, template, context, **extra):
+    medicao = medicao_atual()
+    if medicao is not None and 'inicio_template' in medicao:
+        medicao['template'] += time.perf_counter() - medicao.pop('inicio_template')
+
+@app.before_request
+def iniciar_medicao():
+    if app.config['METRICAS_HABILITADAS']:
+        g.medicao = defaultdict(float, inicio=time.perf_counter(), repeticoes=defaultdict(int),
+                                rota=request.url_rule.rule if request.url_rule else 'sem_rota',
+                                metodo=request.method, caminho=request.path)
+
+def finalizar_medicao(medicao, status):
+    """Registra as métricas da requisição uma única vez.
+
+    Não usa request nem g: nas respostas em fluxo roda quando o servidor
+    fecha a resposta, depois de o template ter sido renderizado.
+    """
+    if medicao is None or 'total' in medicao:
+        return None
+    total = time.perf_counter() - medicao['inicio']
+    rota = medicao['rota']
+    metricas.contar('inventario_requisicoes_total', ajuda='Requisições atendidas.',
+                    rota=rota, metodo=medicao['metodo'], status=status)
+    metricas.observar('inventario_requisicao_segundos', total, 'Latência total das requisições.', rota=rota)
+    metricas.observar('inventario_template_segundos', medicao['template'],
+                      'Tempo de renderização de templates por requisição.', rota=rota)
+    metricas.observar('inventario_sql_segundos', medicao['sql'], 'Tempo em SQL por requisição.', rota=rota)
+    metricas.contar('inventario_sql_instrucoes_total', medicao['sql_instrucoes'],
+                    'Instruções SQL executadas.', rota=rota)
+    limite = app.config['METRICAS_LIMITE_REPETICOES']
+    for instrucao, vezes in medicao['repeticoes'].items():
+        if limite and vezes > limite:
+            app.logger.warning('Possível N+1 em %s: %d execuções de %s', medicao['caminho'], vezes,
+                               ' '.join(instrucao.split())[:300])
+    medicao['total'] = total
+    return medicao
+
+@app.after_request
+def registrar_medicao(resposta):
+    medicao = g.get('medicao')
+    if medicao is None:
+        return resposta
+    if resposta.is_streamed:
+        # O corpo ainda vai ser gerado (templates em fluxo, arquivos): g.medicao
+        # continua valendo durante a renderização e a medição fecha com a
+        # resposta. Sem Server-Timing aqui: os cabeçalhos já saíram.
+        status = resposta.status_code
+        resposta.call_on_close(lambda: finalizar_medicao(medicao, status))
+        return resposta
+    g.pop('medicao')
+    finalizar_medicao(medicao, resposta.status_code)
+    # Mesmo detalhamento visível nas ferramentas de desenvolvedor do navegador
+    resposta.headers['Server-Timing'] = ', '.join(
+        f'{etapa};dur={medicao[etapa] * 1000:.1f}'
+        for etapa in ('sql', 'template', 'qr_code', 'hash_senha', 'total'))
+    return resposta
+
+@app.teardown_request
+def registrar_medicao_com_erro(erro):
+    if erro is not None:
+        finalizar_medicao(g.pop('medicao', None), 500)
 
 # Configuração do Flask-Login
-login_manager = LoginManager(app)
+login_manager = LoginManager()
 login_manager.login_view = 'login'
 
 # ===================================
@@ -26,18 +454,45 @@ class Categoria(db.Model):
 
 class Material(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    nome = db.Column(db.String(100), nullable=False)
+    nome = db.Column(db.String(100), nullable=False, index=True)
     descricao = db.Column(db.String(200), nullable=True)
     quantidade = db.Column(db.Integer, default=0)
     # O campo quantidade_minima foi removido
     quantidade_alerta_requisicao = db.Column(db.Integer, default=0)
     quantidade_alerta_estoque = db.Column(db.Integer, default=0)
     qr_code_file = db.Column(db.String(100), nullable=True)
-    categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id'), nullable=True)
+    categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id'), nullable=True, index=True)
+    # Situação de alerta calculada pelo próprio SQLite (coluna gerada): fica sempre
+    # em dia com qualquer mudança de quantidade, venha do ORM, de um UPDATE direto
+    # ou da importação. 0 = normal, 1 = requisição necessária, 2 = estoque crítico
+    alerta = db.Column(db.Integer, db.Computed(
+        "CASE WHEN coalesce(quantidade, 0) < coalesce(quantidade_alerta_estoque, 0) THEN 2 "
+        "WHEN coalesce(quantidade, 0) < coalesce(quantidade_alerta_requisicao, 0) THEN 1 "
+        "ELSE 0 END",
+        persisted=False,
+    ))
+
+    __table_args__ = (
+        # Índice parcial: só contém os itens em alerta, então o painel de compras
+        # custa o mesmo com 1 mil ou 1 milhão de materiais
+        db.Index('ix_material_alerta', 'alerta', 'categoria_id', sqlite_where=db.text('alerta > 0')),
+    )
     
     def __repr__(self):
         return f'<Material {self.nome}>'
 
+ALERTA_NORMAL = 0
+ALERTA_REQUISICAO = 1
+ALERTA_CRITICO = 2
+app.jinja_env.globals.update(ALERTA_REQUISICAO=ALERTA_REQUISICAO, ALERTA_CRITICO=ALERTA_CRITICO)
+
+# Materiais sem categoria ficam no início da ordenação por categoria (categoria 0).
+# O literal precisa ir direto no SQL (e não como parâmetro) para que o SQLite
+# reconheça a mesma expressão dos índices abaixo.
+categoria_ordem = db.func.coalesce(Material.categoria_id, db.literal_column('0'))
+db.Index('ix_material_categoria_ordem', categoria_ordem)
+db.Index('ix_material_categoria_nome', categoria_ordem, Material.nome)
+
 # Modelo de Usuário
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -47,10 +502,10 @@ class User(UserMixin, db.Model):
     approved = db.Column(db.Boolean, default=False)     # Novo usuário precisa de aprovação
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = gerar_hash_senha(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verificar_hash_senha(self.password_hash, password)
     
     # Apenas usuários aprovados são considerados ativos pelo Flask-Login
     @property
@@ -60,28 +515,270 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+# Modelo de Movimentação: histórico de entradas, saídas e ajustes (somente inserção)
+class Movimentacao(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
+    tipo = db.Column(db.String(10), nullable=False)        # 'entrada', 'saida' ou 'ajuste'
+    quantidade = db.Column(db.Integer, nullable=False)    # Variação aplicada (negativa nas saídas)
+    saldo = db.Column(db.Integer, nullable=False)         # Quantidade do material após a movimentação
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    observacao = db.Column(db.String(200), nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    usuario = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_movimentacao_material', 'material_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<Movimentacao {self.tipo} {self.quantidade} material={self.material_id}>'
+
+class VersaoDados(db.Model):
+    """Contadores de versão dos dados de referência (uma linha por conjunto).
+
+    Gatilhos no banco incrementam a versão a cada alteração, então todos os
+    workers percebem a mudança lendo uma única linha.
+    """
+    __tablename__ = 'versao_dados'
+    nome = db.Column(db.String(30), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+    alterado_em = db.Column(db.DateTime, nullable=True)   # UTC, preenchido pelos gatilhos
+
+class AlteracaoMaterial(db.Model):
+    """Última alteração de cada material, numerada em sequência (uma linha por material).
+
+    Mantida por gatilhos; alimenta o "o que mudou desde a versão N" da API.
+    Materiais removidos ficam com removido = True.
+    """
+    __tablename__ = 'material_alteracao'
+    material_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    versao = db.Column(db.Integer, nullable=False, unique=True, index=True)
+    removido = db.Column(db.Boolean, nullable=False, default=False)
+
+class Tarefa(db.Model):
+    """Fila persistente de tarefas em segundo plano (sobrevive a reinícios)."""
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(30), nullable=False)
+    parametros = db.Column(db.Text, nullable=False, default='{}')   # JSON
+    situacao = db.Column(db.String(12), nullable=False, default='pendente')  # pendente, executando, concluida, falhou
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    max_tentativas = db.Column(db.Integer, nullable=False, default=3)
+    progresso = db.Column(db.Float, nullable=False, default=0)
+    mensagem = db.Column(db.String(200), nullable=True)
+    resultado = db.Column(db.Text, nullable=True)                   # JSON
+    erro = db.Column(db.Text, nullable=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    trabalhador = db.Column(db.String(80), nullable=True)           # host:pid de quem está executando
+    executar_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime, nullable=True)
+    concluido_em = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # A próxima tarefa pendente sai direto do índice, sem varrer as concluídas
+        db.Index('ix_tarefa_fila', 'executar_em', 'id', sqlite_where=db.text("situacao = 'pendente'")),
+        db.Index('ix_tarefa_situacao', 'situacao', 'concluido_em'),
+    )
+
+    def __repr__(self):
+        return f'<Tarefa {self.id} {self.tipo} {self.situacao}>'
+
+class EstoqueDiario(db.Model):
+    """Quantidade de cada material por dia, gravada só nos dias em que mudou.
+
+    A quantidade num dia D é a da linha mais recente com data <= D.
+    consumo_acumulado soma todas as quedas de quantidade desde o primeiro
+    registro do material: o consumo entre duas datas é a diferença entre
+    os acumulados, sem percorrer os dias intermediários.
+    """
+    __tablename__ = 'estoque_diario'
+    material_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Date, primary_key=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+    consumo_acumulado = db.Column(db.Integer, nullable=False, default=0)
+
+    # Sem rowid: a chave (material_id, data) é o próprio índice da tabela
+    __table_args__ = ({'sqlite_with_rowid': False},)
+
+class ConsumoMaterial(db.Model):
+    """Consumo de cada material por janela de dias, recalculado junto com o retrato diário."""
+    __tablename__ = 'consumo_material'
+    janela = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    material_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    categoria_id = db.Column(db.Integer, nullable=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+    consumo = db.Column(db.Integer, nullable=False)
+    dias = db.Column(db.Float, nullable=False)
+    taxa = db.Column(db.Float, nullable=False)                      # consumo por dia
+    dias_ate_ruptura = db.Column(db.Float, nullable=True)           # NULL sem consumo no período
+    participacao_categoria = db.Column(db.Float, nullable=True)     # fração do consumo da categoria
+
+    __table_args__ = (
+        db.Index('ix_consumo_material_ruptura', 'janela', 'dias_ate_ruptura'),
+        db.Index('ix_consumo_material_categoria', 'janela', 'categoria_id', 'dias_ate_ruptura'),
+        {'sqlite_with_rowid': False},
+    )
+
+class OperacaoCliente(db.Model):
+    """Operações já aplicadas pela API, pelo id gerado no cliente (torna o reenvio seguro).
+
+    O id só é único por usuário: dois coletores podem gerar o mesmo id sem
+    que a operação de um seja tomada como reenvio da do outro.
+    """
+    __tablename__ = 'operacao_cliente'
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    id = db.Column(db.String(64), primary_key=True)
+    resultado = db.Column(db.Text, nullable=False)        # JSON devolvido na primeira aplicação
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Cache de usuários por processo: evita o SELECT do usuário em toda requisição
+usuarios_cache = {}
+usuarios_cache_lock = threading.Lock()
+
+def invalidar_usuario(user_id):
+    with usuarios_cache_lock:
+        usuarios_cache.pop(int(user_id), None)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    agora = time.monotonic()
+    with usuarios_cache_lock:
+        item = usuarios_cache.get(user_id)
+    if item is None or item[0] <= agora:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        # Guardamos uma cópia desligada da sessão; cada requisição recebe a sua
+        db.session.expunge(user)
+        # Usa a tupla local: outra thread pode invalidar a entrada logo após o lock
+        item = (agora + app.config['USUARIO_CACHE_TTL'], user)
+        with usuarios_cache_lock:
+            usuarios_cache[user_id] = item
+    # load=False liga a cópia à sessão atual sem ir ao banco
+    return db.session.merge(item[1], load=False)
 
 # ===================================
-# Configuração para armazenar os QR Codes
+# QR Codes: geração sob demanda com cache em memória (LRU) e em disco
 # ===================================
 qr_folder = os.path.join('static', 'qr_codes')
-if not os.path.exists(qr_folder):
-    os.makedirs(qr_folder)
 
-def gerar_qr_code(material):
+QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+@medir_tempo('qr_code', 'Tempo gasto gerando imagens de QR Code.')
+def gerar_qr_code(material_id, formato='png'):
     # Ajuste o endereço conforme necessário (exemplo para intranet)
-    conteudo = f"http://192.168.0.100/editar/{material.id}"
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    conteudo = f"{app.config['QR_URL_BASE']}/editar/{material_id}"
+    # Importados só aqui: qrcode e PIL pesam na partida de cada worker e comando
+    # do flask, e a maioria dos processos nunca gera um QR Code
+    import qrcode
+    import qrcode.image.svg
+    fabrica = qrcode.image.svg.SvgPathImage if formato == 'svg' else None
+    qr = qrcode.QRCode(version=1, box_size=10, border=5, image_factory=fabrica)
     qr.add_data(conteudo)
     qr.make(fit=True)
+    if formato == 'svg':
+        return qr.make_image().to_string()
     img = qr.make_image(fill_color="black", back_color="white")
-    nome_arquivo = f"qr_{material.id}.png"
-    caminho_arquivo = os.path.join(qr_folder, nome_arquivo)
-    img.save(caminho_arquivo)
-    return nome_arquivo
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@app.template_global()
+def versao_qr():
+    # O conteúdo do QR depende de QR_URL_BASE: trocar o endereço muda o nome dos
+    # arquivos, a chave do cache e, por consequência, a ETag
+    return hashlib.sha1(app.config['QR_URL_BASE'].encode('utf-8')).hexdigest()[:8]
+
+class CacheQR:
+    """Cache LRU dos QR Codes em memória, com cópia persistente em disco.
+
+    Os arquivos se chamam qr_<id>_<versão>.<formato> (veja versao_qr); os do
+    formato antigo, qr_<id>.png, foram gerados com o endereço fixo e são ignorados.
+    """
+
+    def __init__(self, pasta, capacidade):
+        self.pasta = pasta
+        self.capacidade = capacidade
+        self.itens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def caminho(self, material_id, formato):
+        return os.path.join(self.pasta, f"qr_{material_id}_{versao_qr()}.{formato}")
+
+    def obter(self, material_id, formato, existe=None):
+        """Retorna (bytes, etag) ou None se o material não existir.
+
+        `existe` só é consultado quando o QR não está em nenhum dos caches.
+        """
+        chave = (versao_qr(), material_id, formato)
+        with self.lock:
+            if chave in self.itens:
+                self.itens.move_to_end(chave)
+                return self.itens[chave]
+        caminho = self.caminho(material_id, formato)
+        try:
+            with open(caminho, 'rb') as arquivo:
+                dados = arquivo.read()
+        except FileNotFoundError:
+            if existe is not None and not existe(material_id):
+                return None
+            dados = gerar_qr_code(material_id, formato)
+            # Grava em arquivo temporário e renomeia: outro worker nunca lê um PNG pela metade
+            temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                arquivo = open(temporario, 'wb')
+            except FileNotFoundError:
+                # A pasta só é criada quando o primeiro QR Code é gravado
+                os.makedirs(self.pasta, exist_ok=True)
+                arquivo = open(temporario, 'wb')
+            with arquivo:
+                arquivo.write(dados)
+            os.replace(temporario, caminho)
+        item = (dados, hashlib.sha1(dados).hexdigest())
+        with self.lock:
+            self.itens[chave] = item
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.capacidade:
+                self.itens.popitem(last=False)
+        return item
+
+    def descartar(self, material_id):
+        self.descartar_varios([material_id])
+
+    def descartar_varios(self, ids):
+        self.esquecer(ids)
+        self.apagar_arquivos(ids)
+
+    def esquecer(self, ids):
+        versao = versao_qr()
+        with self.lock:
+            for material_id in ids:
+                for formato in QR_MIMETYPES:
+                    self.itens.pop((versao, material_id, formato), None)
+
+    def apagar_arquivos(self, ids):
+        # Tenta remover direto: um arquivo ausente custa uma exceção, não um stat a mais
+        for material_id in ids:
+            for formato in QR_MIMETYPES:
+                try:
+                    os.remove(self.caminho(material_id, formato))
+                except FileNotFoundError:
+                    pass
+
+# A capacidade é ajustada em criar_app(), depois de aplicada a configuração
+cache_qr = CacheQR(qr_folder, app.config['QR_CACHE_MEMORIA'])
+
+def material_existe(material_id):
+    return db.session.query(Material.id).filter_by(id=material_id).first() is not None
+
+@app.template_global()
+def qr_svg(material_id):
+    # SVG embutido direto na listagem: nenhuma requisição extra por linha
+    item = cache_qr.obter(material_id, 'svg')
+    return Markup(item[0].decode('utf-8'))
 
 def prepopulate_categories():
     categorias_padrao = [
@@ -102,35 +799,639 @@ def prepopulate_categories():
         "Poda, jardinagem e grama",
         "Segurança"
     ]
-    categorias_padrao = sorted(categorias_padrao)
-    for nome in categorias_padrao:
-        if not Categoria.query.filter_by(nome=nome).first():
-            nova_categoria = Categoria(nome=nome)
-            db.session.add(nova_categoria)
+    # Um único INSERT com todas as linhas; as que já existem são ignoradas pelo UNIQUE(nome)
+    db.session.execute(sqlite_insert(Categoria.__table__)
+                       .values([{'nome': nome} for nome in sorted(categorias_padrao)])
+                       .on_conflict_do_nothing(index_elements=['nome']))
+    db.session.execute(sqlite_insert(VersaoDados.__table__)
+                       .values([{'nome': nome, 'versao': 0} for nome in CONJUNTOS_VERSIONADOS])
+                       .on_conflict_do_nothing(index_elements=['nome']))
     db.session.commit()
 
+def migrar_operacao_cliente(conexao):
+    # A chave era só o id do cliente; passa a ser (usuario_id, id)
+    chave = {linha[1] for linha in conexao.execute(db.text('PRAGMA table_info("operacao_cliente")')) if linha[5]}
+    if not chave or 'usuario_id' in chave:
+        return
+    conexao.execute(db.text('ALTER TABLE operacao_cliente RENAME TO operacao_cliente_antiga'))
+    conexao.execute(db.text('DROP INDEX IF EXISTS ix_operacao_cliente_criado_em'))
+    OperacaoCliente.__table__.create(conexao)
+    conexao.execute(db.text(
+        'INSERT INTO operacao_cliente (usuario_id, id, resultado, criado_em) '
+        'SELECT usuario_id, id, resultado, criado_em FROM operacao_cliente_antiga WHERE usuario_id IS NOT NULL'))
+    conexao.execute(db.text('DROP TABLE operacao_cliente_antiga'))
+
+def atualizar_esquema():
+    # create_all não cria colunas nem índices novos em tabelas que já existem
+    with db.engine.begin() as conexao:
+        migrar_operacao_cliente(conexao)
+        for tabela in db.metadata.sorted_tables:
+            existentes = {linha[1] for linha in conexao.execute(db.text(f'PRAGMA table_xinfo("{tabela.name}")'))}
+            for coluna in tabela.columns:
+                if coluna.name not in existentes:
+                    ddl = CreateColumn(coluna).compile(dialect=db.engine.dialect)
+                    conexao.execute(db.text(f'ALTER TABLE "{tabela.name}" ADD COLUMN {ddl}'))
+            for indice in tabela.indexes:
+                conexao.execute(CreateIndex(indice, if_not_exists=True))
+        for comando in SQL_VERSAO_CATEGORIAS + SQL_ALTERACOES_MATERIAL:
+            conexao.execute(db.text(comando))
+    criar_indice_busca()
+
+# ===================================
+# Versões dos dados e cache de categorias
+# ===================================
+
+# 'categorias': lista de categorias; 'inventario': qualquer material ou categoria;
+# 'estoque_diario' e 'consumo_material': dia (date.toordinal) do último retrato
+# diário do estoque e do último cálculo do consumo
+CONJUNTOS_VERSIONADOS = ('categorias', 'inventario', 'estoque_diario', 'consumo_material')
+
+# Qualquer escrita nas tabelas (formulário, importação, SQL direto) muda a versão
+SQL_VERSAO_CATEGORIAS = [
+    f"""CREATE TRIGGER IF NOT EXISTS categoria_versao_{evento.lower()} AFTER {evento} ON categoria BEGIN
+        UPDATE versao_dados SET versao = versao + 1 WHERE nome = 'categorias';
+    END"""
+    for evento in ('INSERT', 'UPDATE', 'DELETE')
+] + [
+    f"""CREATE TRIGGER IF NOT EXISTS inventario_versao_{tabela}_{evento.lower()} AFTER {evento} ON {tabela} BEGIN
+        UPDATE versao_dados SET versao = versao + 1, alterado_em = CURRENT_TIMESTAMP
+        WHERE nome = 'inventario';
+    END"""
+    for tabela in ('material', 'categoria')
+    for evento in ('INSERT', 'UPDATE', 'DELETE')
+]
+
+def versao_dados(nome):
+    """(versao, alterado_em) do conjunto, ou None se a linha ainda não existe."""
+    return db.session.execute(
+        db.select(VersaoDados.versao, VersaoDados.alterado_em).where(VersaoDados.nome == nome)).first()
+
+CategoriaCache = namedtuple('CategoriaCache', 'id nome')
+
+class CacheCategorias:
+    """Lista de categorias ordenada por nome, recarregada só quando a versão muda.
+
+    Guarda tuplas (id, nome), não objetos da sessão, para poder ser
+    compartilhada entre threads. Sem a linha de versão (banco antigo, antes
+    do `flask inicializar`), consulta a tabela toda vez.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versao = None
+        self.categorias = []
+
+    def listar(self):
+        linha = versao_dados('categorias')
+        versao = linha.versao if linha else None
+        with self.lock:
+            if versao is not None and versao == self.versao:
+                return self.categorias
+        linhas = db.session.execute(db.select(Categoria.id, Categoria.nome).order_by(Categoria.nome))
+        categorias = [CategoriaCache(*linha) for linha in linhas]
+        with self.lock:
+            self.versao, self.categorias = versao, categorias
+        return categorias
+
+cache_categorias = CacheCategorias()
+
+# ===================================
+# Cache HTTP (ETag/Last-Modified) e compressão das respostas
+# ===================================
+
+def assinatura_aplicacao():
+    # Muda quando o código, os templates ou os pacotes estáticos mudam, para um
+    # deploy novo não servir 304 de HTML antigo (que aponta para CSS/JS antigos)
+    caminhos = [os.path.abspath(__file__)]
+    manifesto = os.path.join(app.static_folder, estaticos.PASTA_DIST, estaticos.MANIFESTO)
+    if os.path.exists(manifesto):
+        caminhos.append(manifesto)
+    pasta = os.path.join(app.root_path, app.template_folder)
+    for raiz, _, arquivos in os.walk(pasta):
+        caminhos.extend(os.path.join(raiz, nome) for nome in arquivos)
+    # A versão dos QR Codes entra porque as páginas levam ?v=<versão> nas imagens
+    partes = [f'{c}:{os.path.getmtime(c)}' for c in sorted(caminhos)] + [versao_qr()]
+    return hashlib.sha1('|'.join(partes).encode()).hexdigest()
+
+# Calculada em criar_app()
+ASSINATURA_APLICACAO = None
+
+def pagina_condicional(view):
+    """Responde 304 sem consultar materiais nem renderizar se o inventário não mudou.
+
+    A ETag combina a versão do inventário (uma linha de versao_dados) com o
+    usuário, a URL completa e a versão do código; páginas com mensagens
+    flash pendentes são sempre renderizadas.
+    """
+    @wraps(view)
+    def condicional(*args, **kwargs):
+        linha = versao_dados('inventario')
+        if linha is None or '_flashes' in session:
+            return view(*args, **kwargs)
+        etag = hashlib.sha1('|'.join((
+            ASSINATURA_APLICACAO, str(linha.versao), str(current_user.get_id()),
+            request.full_path, app.config['QR_LISTAGEM'],
+        )).encode()).hexdigest()[:24]
+        alterado = linha.alterado_em.replace(tzinfo=timezone.utc) if linha.alterado_em else None
+        if request.if_none_match:
+            inalterado = request.if_none_match.contains_weak(etag)
+        else:
+            inalterado = bool(alterado and request.if_modified_since and alterado <= request.if_modified_since)
+        resposta = Response(status=304) if inalterado else make_response(view(*args, **kwargs))
+        resposta.set_etag(etag, weak=True)
+        if alterado:
+            resposta.last_modified = alterado
+        # O navegador guarda a página, mas sempre pergunta se ela mudou
+        resposta.headers['Cache-Control'] = 'private, no-cache'
+        resposta.vary.add('Cookie')
+        return resposta
+    return condicional
+
+def agrupar_fluxo(partes, tamanho):
+    """Junta os pedaços pequenos do Jinja em blocos de ~`tamanho` caracteres."""
+    buffer, acumulado = [], 0
+    for parte in partes:
+        buffer.append(parte)
+        acumulado += len(parte)
+        if acumulado >= tamanho:
+            yield ''.join(buffer)
+            buffer, acumulado = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def transmitir_template(nome, **contexto):
+    # Com mensagens flash pendentes a página é renderizada inteira: em fluxo, o
+    # cookie da sessão sai antes do template consumir as mensagens
+    if '_flashes' in session:
+        return render_template(nome, **contexto)
+    # O cabeçalho e as primeiras linhas da tabela saem antes do resto ser renderizado
+    return Response(agrupar_fluxo(stream_template(nome, **contexto), app.config['COMPRESSAO_BLOCO']),
+                    mimetype='text/html')
+
+TIPOS_COMPRESSIVEIS = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript', 'application/javascript',
+    'application/json', 'application/x-ndjson', 'image/svg+xml',
+}
+
+def codificacao_aceita():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compressor(codificacao):
+    if codificacao == 'br':
+        objeto = brotli.Compressor(quality=app.config['COMPRESSAO_NIVEL_BROTLI'])
+        return objeto.process, objeto.flush, objeto.finish
+    # wbits=31: formato gzip (cabeçalho e CRC), não zlib puro
+    objeto = zlib.compressobj(app.config['COMPRESSAO_NIVEL_GZIP'], zlib.DEFLATED, 31)
+    return objeto.compress, lambda: objeto.flush(zlib.Z_SYNC_FLUSH), objeto.flush
+
+def comprimir_fluxo(partes, codificacao, tamanho):
+    processar, descarregar, finalizar = compressor(codificacao)
+    buffer = bytearray()
+    for parte in partes:
+        buffer += parte.encode('utf-8') if isinstance(parte, str) else parte
+        if len(buffer) >= tamanho:
+            # Sync flush por bloco: o navegador já consegue descomprimir o que chegou
+            yield processar(bytes(buffer)) + descarregar()
+            buffer.clear()
+    yield processar(bytes(buffer)) + finalizar()
+
+@app.after_request
+def comprimir_resposta(resposta):
+    if (not app.config['COMPRESSAO_HABILITADA'] or resposta.mimetype not in TIPOS_COMPRESSIVEIS
+            or resposta.status_code in (204, 304) or resposta.direct_passthrough
+            or 'Content-Encoding' in resposta.headers or request.method == 'HEAD'):
+        return resposta
+    resposta.vary.add('Accept-Encoding')
+    codificacao = codificacao_aceita()
+    if codificacao is None:
+        return resposta
+    if resposta.is_streamed:
+        resposta.response = comprimir_fluxo(resposta.response, codificacao, app.config['COMPRESSAO_BLOCO'])
+        resposta.headers.pop('Content-Length', None)
+    else:
+        dados = resposta.get_data()
+        if len(dados) < app.config['COMPRESSAO_MINIMO']:
+            return resposta
+        processar, _, finalizar = compressor(codificacao)
+        resposta.set_data(processar(dados) + finalizar())
+    resposta.headers['Content-Encoding'] = codificacao
+    # O corpo mudou: uma ETag forte deixaria de valer byte a byte
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca:
+        resposta.set_etag(etag, weak=True)
+    return resposta
+
+# ===================================
+# Arquivos estáticos: pacotes com hash no nome e cache longo (veja estaticos.py)
+# ===================================
+
+# Nome lógico -> nome com hash, carregado em criar_app(); vazio se `flask estaticos` nunca rodou
+manifesto_estaticos = {}
+
+@app.template_global()
+def urls_estaticas(nome):
+    """URLs de um pacote de estaticos.PACOTES (ou de um arquivo de static/).
+
+    Com o manifesto, uma única URL com hash, guardada pelo navegador por
+    ESTATICOS_MAX_AGE; sem ele, ou em DEBUG (para as edições em styles.css
+    aparecerem na hora), os arquivos de origem pela rota static comum.
+    """
+    if nome in manifesto_estaticos and not app.debug:
+        return [url_for('estatico_versionado', arquivo=manifesto_estaticos[nome])]
+    return [url_for('static', filename=origem) for origem in estaticos.PACOTES.get(nome, [nome])]
+
+@app.route('/estaticos/<path:arquivo>')
+def estatico_versionado(arquivo):
+    pasta = os.path.join(app.static_folder, estaticos.PASTA_DIST)
+    opcoes = {'mimetype': mimetypes.guess_type(arquivo)[0], 'max_age': app.config['ESTATICOS_MAX_AGE']}
+    compressivel = arquivo.endswith(estaticos.COMPRESSIVEIS)
+    resposta = None
+    if compressivel:
+        # Versões já comprimidas na geração dos pacotes (a .br só existe se havia brotli)
+        for sufixo, codificacao in (('.br', 'br'), ('.gz', 'gzip')):
+            if not request.accept_encodings[codificacao]:
+                continue
+            try:
+                resposta = send_from_directory(pasta, arquivo + sufixo, **opcoes)
+            except NotFound:
+                continue
+            resposta.headers['Content-Encoding'] = codificacao
+            break
+    if resposta is None:
+        resposta = send_from_directory(pasta, arquivo, **opcoes)
+    if compressivel:
+        resposta.vary.add('Accept-Encoding')
+    # O conteúdo de um nome com hash nunca muda: nem F5 precisa revalidar
+    resposta.cache_control.immutable = True
+    return resposta
+
+@app.cli.command('estaticos')
+def estaticos_comando():
+    """Gera em static/dist os pacotes CSS/JS com hash no nome (rode a cada deploy)."""
+    manifesto = estaticos.gerar(app.static_folder)
+    for nome, final in sorted(manifesto.items()):
+        caminho = os.path.join(app.static_folder, estaticos.PASTA_DIST, *final.split('/'))
+        click.echo(f'{nome} -> {final} ({os.path.getsize(caminho) / 1024:.1f} KB)')
+    click.echo('Reinicie os workers para passarem a usar os arquivos novos.')
+
+# ===================================
+# Busca textual (SQLite FTS5)
+# ===================================
+
+# Tabela virtual fora do db.metadata (create_all não sabe criá-la); o rowid é o id do material.
+# remove_diacritics faz "eletrica" encontrar "Elétrica"; prefix acelera as buscas por prefixo.
+material_fts = db.table('material_fts', db.column('rowid'), db.column('rank'))
+
+SQL_INDICE_BUSCA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS material_fts USING fts5(
+        nome, descricao, categoria,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS material_fts_insert AFTER INSERT ON material BEGIN
+        INSERT INTO material_fts (rowid, nome, descricao, categoria)
+        VALUES (new.id, new.nome, coalesce(new.descricao, ''),
+                coalesce((SELECT nome FROM categoria WHERE id = new.categoria_id), ''));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS material_fts_update
+    AFTER UPDATE OF nome, descricao, categoria_id ON material BEGIN
+        UPDATE material_fts SET
+            nome = new.nome,
+            descricao = coalesce(new.descricao, ''),
+            categoria = coalesce((SELECT nome FROM categoria WHERE id = new.categoria_id), '')
+        WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS material_fts_delete AFTER DELETE ON material BEGIN
+        DELETE FROM material_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categoria_fts_update AFTER UPDATE OF nome ON categoria BEGIN
+        UPDATE material_fts SET categoria = new.nome
+        WHERE rowid IN (SELECT id FROM material WHERE categoria_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categoria_fts_delete AFTER DELETE ON categoria BEGIN
+        UPDATE material_fts SET categoria = ''
+        WHERE rowid IN (SELECT id FROM material WHERE categoria_id = old.id);
+    END""",
+]
+
+def criar_indice_busca():
+    with db.engine.begin() as conexao:
+        existia = conexao.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'material_fts'")).first()
+        try:
+            for comando in SQL_INDICE_BUSCA:
+                conexao.execute(db.text(comando))
+        except OperationalError as erro:
+            # SQLite compilado sem FTS5: a busca cai no LIKE (mais lento)
+            app.logger.warning('Busca textual sem FTS5: %s', erro.orig)
+            return
+        if not existia:
+            # Primeira criação: indexa de uma vez o que já está no banco
+            conexao.execute(db.text("""
+                INSERT INTO material_fts (rowid, nome, descricao, categoria)
+                SELECT m.id, m.nome, coalesce(m.descricao, ''), coalesce(c.nome, '')
+                FROM material m LEFT JOIN categoria c ON c.id = m.categoria_id
+            """))
+
+def consulta_fts(texto):
+    # Só palavras entram na consulta (sem operadores do FTS5); cada uma vira prefixo
+    palavras = re.findall(r'\w+', texto)
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
+
+def buscar_materiais(texto, pagina=1, por_pagina=50):
+    """Retorna (materiais da página, existe_proxima) ordenados por relevância."""
+    consulta = consulta_fts(texto)
+    if not consulta:
+        return [], False
+    base = Material.query.options(joinedload(Material.categoria))
+    inicio = (pagina - 1) * por_pagina
+    try:
+        materiais = (base.join(material_fts, material_fts.c.rowid == Material.id)
+                     .filter(db.text('material_fts MATCH :consulta').bindparams(consulta=consulta))
+                     .order_by(material_fts.c.rank)
+                     .offset(inicio).limit(por_pagina + 1).all())
+    except OperationalError:
+        db.session.rollback()
+        padrao = f'%{texto.strip()}%'
+        materiais = (base.outerjoin(Categoria)
+                     .filter(db.or_(Material.nome.ilike(padrao), Material.descricao.ilike(padrao),
+                                    Categoria.nome.ilike(padrao)))
+                     .order_by(Material.nome, Material.id)
+                     .offset(inicio).limit(por_pagina + 1).all())
+    return materiais[:por_pagina], len(materiais) > por_pagina
+
+# ===================================
+# Paginação por chave (keyset) da listagem
+# ===================================
+
+# Colunas de ordenação de cada modo; o id sempre fecha a chave para desempate
+ORDENACOES = {
+    'alfabetica': (Material.nome, Material.id),
+    'categoria': (categoria_ordem, Material.id),
+    'ambos': (categoria_ordem, Material.nome, Material.id),
+}
+ORDENACAO_PADRAO = (Material.id,)
+# Tipo de cada valor do cursor, na mesma ordem das colunas acima
+TIPOS_CURSOR = {
+    'alfabetica': (str, int),
+    'categoria': (int, int),
+    'ambos': (int, str, int),
+}
+TIPOS_CURSOR_PADRAO = (int,)
+
+# O termo "alerta > 0" repete a condição do índice parcial para o SQLite poder usá-lo
+FILTROS_ALERTA = {
+    'critico': db.and_(Material.alerta > 0, Material.alerta == ALERTA_CRITICO),
+    'requisicao': db.and_(Material.alerta > 0, Material.alerta == ALERTA_REQUISICAO),
+    'qualquer': Material.alerta > 0,
+}
+
+def codificar_cursor(valores):
+    dados = json.dumps(list(valores), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(dados).decode('ascii')
+
+def decodificar_cursor(cursor, tipos):
+    # Cursor inválido ou adulterado volta para a primeira página
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(valores, list) or len(valores) != len(tipos):
+        return None
+    # Listas/objetos iriam para o SQL como parâmetros; bool passaria por int
+    if any(type(valor) is not tipo for valor, tipo in zip(valores, tipos)):
+        return None
+    return valores
+
+def valores_ordenacao(material, order):
+    if order == 'alfabetica':
+        return (material.nome, material.id)
+    if order == 'categoria':
+        return (material.categoria_id or 0, material.id)
+    if order == 'ambos':
+        return (material.categoria_id or 0, material.nome, material.id)
+    return (material.id,)
+
+def paginar_materiais(order, cursor=None, por_pagina=50, categoria=None, alerta=None):
+    colunas = ORDENACOES.get(order, ORDENACAO_PADRAO)
+    consulta = Material.query.options(joinedload(Material.categoria))
+    if categoria == 'sem':
+        consulta = consulta.filter(Material.categoria_id.is_(None))
+    elif categoria:
+        consulta = consulta.filter(Material.categoria_id == categoria)
+    if alerta in FILTROS_ALERTA:
+        consulta = consulta.filter(FILTROS_ALERTA[alerta])
+    valores = decodificar_cursor(cursor, TIPOS_CURSOR.get(order, TIPOS_CURSOR_PADRAO)) if cursor else None
+    if valores is not None:
+        # O primeiro termo redundante permite ao SQLite buscar direto no índice
+        # (sem ele, a comparação de tuplas sobre expressões vira varredura)
+        consulta = consulta.filter(
+            colunas[0] >= valores[0],
+            db.tuple_(*colunas) > db.tuple_(*valores),
+        )
+    # Busca um item a mais só para saber se existe próxima página
+    materiais = consulta.order_by(*colunas).limit(por_pagina + 1).all()
+    proximo = None
+    if len(materiais) > por_pagina:
+        materiais = materiais[:por_pagina]
+        proximo = codificar_cursor(valores_ordenacao(materiais[-1], order))
+    return materiais, proximo
+
+# ===================================
+# Movimentações de estoque (atualizações atômicas + histórico)
+# ===================================
+
+TIPOS_MOVIMENTACAO = ('entrada', 'saida', 'ajuste')
+
+class EstoqueInsuficiente(Exception):
+    def __init__(self, material_id, quantidade):
+        super().__init__(f'Estoque insuficiente para retirar {quantidade} unidade(s).')
+        self.material_id = material_id
+        self.quantidade = quantidade
+
+def registrar_movimentacao(material_id, tipo, delta, saldo, usuario_id=None, observacao=None):
+    db.session.execute(Movimentacao.__table__.insert().values(
+        material_id=material_id, tipo=tipo, quantidade=delta, saldo=saldo,
+        usuario_id=usuario_id, observacao=observacao, criado_em=datetime.utcnow(),
+    ))
+
+def movimentar_estoque(material_id, tipo, delta, usuario_id=None, observacao=None,
+                       permitir_negativo=False):
+    """Soma `delta` à quantidade num único UPDATE e registra a movimentação.
+
+    Nada é lido antes da escrita, então duas retiradas simultâneas nunca se
+    sobrescrevem. Sem `permitir_negativo`, o UPDATE só acontece se o saldo
+    continuar >= 0. Não faz commit: o chamador decide a transação.
+    """
+    tabela = Material.__table__
+    novo_saldo = db.func.coalesce(tabela.c.quantidade, 0) + delta
+    comando = tabela.update().where(tabela.c.id == material_id)
+    if not permitir_negativo:
+        comando = comando.where(novo_saldo >= 0)
+    saldo = db.session.execute(
+        comando.values(quantidade=novo_saldo).returning(tabela.c.quantidade)
+    ).scalar()
+    if saldo is None:
+        if not material_existe(material_id):
+            abort(404)
+        raise EstoqueInsuficiente(material_id, -delta)
+    registrar_movimentacao(material_id, tipo, delta, saldo, usuario_id, observacao)
+    return saldo
+
+def historico_ajuste(condicao, quantidade, usuario_id=None, observacao=None):
+    """INSERT ... SELECT do ajuste para a quantidade absoluta dos materiais em `condicao`."""
+    tabela = Material.__table__
+    return Movimentacao.__table__.insert().from_select(
+        ['material_id', 'tipo', 'quantidade', 'saldo', 'usuario_id', 'observacao', 'criado_em'],
+        db.select(
+            tabela.c.id,
+            db.literal('ajuste'),
+            quantidade - db.func.coalesce(tabela.c.quantidade, 0),
+            db.literal(quantidade),
+            db.literal(usuario_id, db.Integer),
+            db.literal(observacao, db.String),
+            db.literal(datetime.utcnow(), db.DateTime),
+        ).where(condicao),
+    )
+
+def ajustar_estoque(material_id, quantidade, usuario_id=None, observacao=None):
+    """Define a quantidade absoluta (ex.: zerar), registrando a diferença.
+
+    O histórico é gravado primeiro com um INSERT ... SELECT, que já trava o
+    banco para escrita; assim a diferença é calculada sobre o valor vigente.
+    """
+    tabela = Material.__table__
+    historico = historico_ajuste(tabela.c.id == material_id, quantidade, usuario_id, observacao)
+    if db.session.execute(historico).rowcount == 0:
+        abort(404)
+    db.session.execute(tabela.update().where(tabela.c.id == material_id).values(quantidade=quantidade))
+    return quantidade
+
+def historico_material(material_id, limite=20):
+    return (Movimentacao.query.options(joinedload(Movimentacao.usuario))
+            .filter_by(material_id=material_id)
+            .order_by(Movimentacao.id.desc())
+            .limit(limite).all())
+
+# ===================================
+# Operações em lote (vários materiais selecionados na listagem)
+# ===================================
+
+ACOES_LOTE = ('remover', 'categoria', 'alertas', 'zerar')
+
+def operar_em_lote(acao, ids, usuario_id=None, categoria_id=None, alertas=None):
+    """Aplica a ação a todos os `ids` com um UPDATE/DELETE ... WHERE id IN por bloco.
+
+    Os blocos (OPERACOES_LOTE ids) mantêm cada instrução abaixo do limite de
+    parâmetros do SQLite; tudo vai numa única transação, sem commit aqui.
+    Retorna os ids efetivamente afetados.
+    """
+    tabela = Material.__table__
+    afetados = []
+    for bloco in lotes(ids, app.config['OPERACOES_LOTE']):
+        condicao = tabela.c.id.in_(bloco)
+        if acao == 'remover':
+            comando = tabela.delete().where(condicao)
+        elif acao == 'categoria':
+            comando = tabela.update().where(condicao).values(categoria_id=categoria_id)
+        elif acao == 'alertas':
+            comando = tabela.update().where(condicao).values(**alertas)
+        else:
+            # Só quem tem saldo entra no histórico; o INSERT ... SELECT vem antes do UPDATE
+            condicao = condicao & (db.func.coalesce(tabela.c.quantidade, 0) != 0)
+            db.session.execute(historico_ajuste(condicao, 0, usuario_id, 'Zerado em lote'))
+            comando = tabela.update().where(condicao).values(quantidade=0)
+        afetados.extend(linha[0] for linha in db.session.execute(comando.returning(tabela.c.id)))
+    return afetados
+
 # ===================================
 # Rotas do Sistema
 # ===================================
 
 @app.route('/')
 @login_required
+@pagina_condicional
 def index():
     order = request.args.get('order', 'todos')
-    if order == 'alfabetica':
-        materiais = Material.query.order_by(Material.nome).all()
-    elif order == 'categoria':
-        materiais = Material.query.order_by(Material.categoria_id).all()
-    elif order == 'ambos':
-        materiais = Material.query.order_by(Material.categoria_id, Material.nome).all()
-    else:
-        materiais = Material.query.all()
-    return render_template('index.html', materiais=materiais)
+    categoria = request.args.get('categoria', '')
+    if categoria != 'sem' and not categoria.isdigit():
+        categoria = ''
+    alerta = request.args.get('alerta', '')
+    por_pagina = request.args.get('por_pagina', app.config['INVENTARIO_POR_PAGINA'], type=int)
+    por_pagina = max(1, min(por_pagina, app.config['INVENTARIO_POR_PAGINA_MAX']))
+    materiais, proximo = paginar_materiais(
+        order,
+        cursor=request.args.get('after'),
+        por_pagina=por_pagina,
+        categoria=categoria,
+        alerta=alerta,
+    )
+    categorias = cache_categorias.listar()
+    filtros = {'order': order, 'categoria': categoria, 'alerta': alerta}
+    return transmitir_template('index.html', materiais=materiais, proximo=proximo,
+                               categorias=categorias, filtros=filtros)
+
+@app.route('/buscar')
+@login_required
+@pagina_condicional
+def buscar():
+    texto = request.args.get('q', '').strip()
+    pagina = max(1, request.args.get('pagina', 1, type=int))
+    materiais, tem_proxima = buscar_materiais(texto, pagina, app.config['BUSCA_POR_PAGINA'])
+    return transmitir_template('buscar.html', materiais=materiais, texto=texto,
+                               pagina=pagina, tem_proxima=tem_proxima)
+
+def materiais_em_alerta(nivel=None, categoria=None):
+    """Itens em alerta e as contagens por categoria, numa única consulta indexada."""
+    consulta = Material.query.options(joinedload(Material.categoria))
+    consulta = consulta.filter(FILTROS_ALERTA.get(nivel, FILTROS_ALERTA['qualquer']))
+    if categoria == 'sem':
+        consulta = consulta.filter(Material.categoria_id.is_(None))
+    elif categoria:
+        consulta = consulta.filter(Material.categoria_id == categoria)
+    materiais = consulta.order_by(Material.alerta.desc(), Material.nome, Material.id).all()
+    contagens = {}
+    for material in materiais:
+        nome = material.categoria.nome if material.categoria else 'Sem categoria'
+        contagem = contagens.setdefault(nome, {'critico': 0, 'requisicao': 0})
+        contagem['critico' if material.alerta == ALERTA_CRITICO else 'requisicao'] += 1
+    return materiais, dict(sorted(contagens.items()))
+
+@app.route('/alertas')
+@login_required
+@pagina_condicional
+def alertas():
+    materiais, contagens = materiais_em_alerta(request.args.get('nivel'), request.args.get('categoria'))
+    return transmitir_template('alertas.html', materiais=materiais, contagens=contagens)
+
+@app.route('/alertas.json')
+@login_required
+@pagina_condicional
+def alertas_json():
+    materiais, contagens = materiais_em_alerta(request.args.get('nivel'), request.args.get('categoria'))
+    return jsonify({
+        'total': len(materiais),
+        'por_categoria': contagens,
+        'materiais': [{
+            'id': m.id,
+            'nome': m.nome,
+            'quantidade': m.quantidade,
+            'quantidade_alerta_requisicao': m.quantidade_alerta_requisicao,
+            'quantidade_alerta_estoque': m.quantidade_alerta_estoque,
+            'nivel': 'critico' if m.alerta == ALERTA_CRITICO else 'requisicao',
+            'categoria': m.categoria.nome if m.categoria else None,
+        } for m in materiais],
+    })
 
 @app.route('/adicionar', methods=['GET', 'POST'])
 @login_required
+@com_retentativa
 def adicionar():
-    categorias = Categoria.query.order_by(Categoria.nome).all()
+    categorias = cache_categorias.listar()
     if request.method == 'POST':
         nome = request.form['nome']
         descricao = request.form['descricao']
@@ -150,39 +1451,102 @@ def adicionar():
             categoria_id=categoria_id
         )
         db.session.add(novo_material)
+        db.session.flush()
+        if quantidade:
+            registrar_movimentacao(novo_material.id, 'entrada', quantidade, quantidade,
+                                   current_user.id, 'Estoque inicial')
+        # O QR Code é desenhado fora da requisição; entra na fila na mesma transação
+        enfileirar('qr_gerar', {'material_ids': [novo_material.id]})
         db.session.commit()
-        nome_qr = gerar_qr_code(novo_material)
-        novo_material.qr_code_file = nome_qr
-        db.session.commit()
+        executor_tarefas.avisar()
         flash('Material adicionado com sucesso!', 'success')
         return redirect(url_for('index'))
     return render_template('adicionar.html', categorias=categorias)
 
 @app.route('/remover/<int:id>', methods=['GET', 'POST'])
 @login_required
+@com_retentativa
 def remover(id):
     material = Material.query.get_or_404(id)
-    if material.qr_code_file:
-        caminho_qr = os.path.join(qr_folder, material.qr_code_file)
-        if os.path.exists(caminho_qr):
-            os.remove(caminho_qr)
     db.session.delete(material)
+    enfileirar('qr_apagar', {'material_ids': [id]})
     db.session.commit()
+    cache_qr.esquecer([id])
+    executor_tarefas.avisar()
     flash('Material removido com sucesso!', 'success')
     return redirect(url_for('index'))
 
+def pagina_de_origem():
+    """Página (com filtros e ordenação) que enviou o formulário, se for deste site."""
+    origem = urlsplit(request.referrer or '')
+    # '//outro.site' e '/\\outro.site' seriam lidos pelo navegador como outro host
+    if (origem.netloc != request.host or not origem.path.startswith('/')
+            or origem.path.startswith(('//', '/\\'))):
+        return url_for('index')
+    return origem.path + (f'?{origem.query}' if origem.query else '')
+
+@app.route('/materiais/lote', methods=['POST'])
+@login_required
+@com_retentativa
+def materiais_em_lote():
+    destino = pagina_de_origem()
+    acao = request.form.get('acao')
+    ids = sorted(set(request.form.getlist('ids', type=int)))
+    if acao not in ACOES_LOTE or not ids:
+        flash('Selecione ao menos um material e uma ação.', 'warning')
+        return redirect(destino)
+    opcoes = {}
+    if acao == 'categoria':
+        categoria = request.form.get('categoria', '')
+        opcoes['categoria_id'] = int(categoria) if categoria.isdigit() else None
+        if opcoes['categoria_id'] is not None and not db.session.get(Categoria, opcoes['categoria_id']):
+            flash('Categoria inexistente.', 'danger')
+            return redirect(destino)
+    elif acao == 'alertas':
+        alertas = {}
+        for campo in ('quantidade_alerta_requisicao', 'quantidade_alerta_estoque'):
+            valor = request.form.get(campo, '').strip()
+            if valor:
+                if not valor.isdigit():
+                    flash('Os limites de alerta devem ser números inteiros não negativos.', 'danger')
+                    return redirect(destino)
+                alertas[campo] = int(valor)
+        if not alertas:
+            flash('Informe ao menos um limite de alerta.', 'warning')
+            return redirect(destino)
+        opcoes['alertas'] = alertas
+    afetados = operar_em_lote(acao, ids, current_user.id, **opcoes)
+    if acao == 'remover' and afetados:
+        # Os arquivos dos QR Codes são apagados pela fila de tarefas, fora da requisição
+        enfileirar('qr_apagar', {'material_ids': afetados})
+    db.session.commit()
+    if acao == 'remover':
+        cache_qr.esquecer(afetados)
+        executor_tarefas.avisar()
+    flash(f'{len(afetados)} material(is) atualizado(s).' if acao != 'remover'
+          else f'{len(afetados)} material(is) removido(s).', 'success')
+    return redirect(destino)
+
 @app.route('/editar/<int:id>', methods=['GET', 'POST'])
 @login_required
+@com_retentativa
 def editar(id):
     material = Material.query.get_or_404(id)
-    categorias = Categoria.query.order_by(Categoria.nome).all()
+    categorias = cache_categorias.listar()
     if request.method == 'POST':
         material.nome = request.form['nome']
         material.descricao = request.form['descricao']
+        # A quantidade nunca é sobrescrita com o valor lido no formulário: aplicamos
+        # só a diferença para não perder retiradas feitas enquanto a tela estava aberta
         if 'zerar' in request.form:
-            material.quantidade = 0
+            ajustar_estoque(id, 0, current_user.id, 'Zerado na edição')
+        elif request.form.get('quantidade_original', '').lstrip('-').isdigit():
+            delta = int(request.form['quantidade']) - int(request.form['quantidade_original'])
+            if delta:
+                movimentar_estoque(id, 'ajuste', delta, current_user.id, 'Edição do material',
+                                   permitir_negativo=True)
         else:
-            material.quantidade = int(request.form['quantidade'])
+            ajustar_estoque(id, int(request.form['quantidade']), current_user.id, 'Edição do material')
         # Atualiza os campos de alerta
         material.quantidade_alerta_requisicao = int(request.form.get('quantidade_alerta_requisicao', material.quantidade_alerta_requisicao))
         material.quantidade_alerta_estoque = int(request.form.get('quantidade_alerta_estoque', material.quantidade_alerta_estoque))
@@ -196,14 +1560,172 @@ def editar(id):
         return redirect(url_for('index'))
     return render_template('editar.html', material=material, categorias=categorias)
 
+@app.route('/movimentar/<int:id>', methods=['GET', 'POST'])
+@login_required
+@com_retentativa
+def movimentar(id):
+    # Tela leve para a leitura do QR Code: entrada ou retirada sem o formulário completo
+    if request.method == 'POST':
+        if request.is_json:
+            dados = request.get_json(silent=True)
+            if not isinstance(dados, dict):
+                return jsonify({'erro': 'Envie um objeto JSON.'}), 400
+        else:
+            dados = request.form
+        tipo = dados.get('tipo')
+        try:
+            quantidade = int(dados.get('quantidade', 0))
+        except (TypeError, ValueError):
+            quantidade = 0
+        erro, status = None, 200
+        if tipo not in ('entrada', 'saida') or quantidade <= 0:
+            erro, status = 'Informe o tipo e uma quantidade maior que zero.', 400
+        else:
+            delta = quantidade if tipo == 'entrada' else -quantidade
+            try:
+                saldo = movimentar_estoque(id, tipo, delta, current_user.id, dados.get('observacao') or None)
+                db.session.commit()
+            except EstoqueInsuficiente as excecao:
+                db.session.rollback()
+                erro, status = str(excecao), 409
+        if request.is_json:
+            if erro:
+                return jsonify({'erro': erro}), status
+            return jsonify({'material_id': id, 'quantidade': saldo})
+        if erro:
+            flash(erro, 'danger')
+        else:
+            flash('Movimentação registrada com sucesso!', 'success')
+        return redirect(url_for('movimentar', id=id))
+    material = Material.query.options(joinedload(Material.categoria)).get_or_404(id)
+    return render_template('movimentar.html', material=material,
+                           movimentacoes=historico_material(id))
+
+@app.route('/qr/<int:id>.<any(png, svg):formato>')
+def qr_code(id, formato):
+    # O QR Code é gerado no primeiro acesso; depois vem do cache
+    item = cache_qr.obter(id, formato, existe=material_existe)
+    if item is None:
+        abort(404)
+    dados, etag = item
+    resposta = Response(dados, mimetype=QR_MIMETYPES[formato])
+    resposta.set_etag(etag)
+    resposta.cache_control.public = True
+    resposta.cache_control.max_age = app.config['QR_CACHE_MAX_AGE']
+    return resposta.make_conditional(request)
+
+@app.route('/metrics')
+def metrics():
+    # Métricas deste processo, com o rótulo worker; com vários workers cada
+    # coleta cai num deles (veja gunicorn.conf.py)
+    if not app.config['METRICAS_HABILITADAS']:
+        abort(404)
+    return Response(metricas.exportar(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ===================================
+# Folhas de etiquetas com QR Code (desenhadas em paralelo, enviadas em fluxo)
+# ===================================
+
+pool_etiquetas = None
+pool_etiquetas_lock = threading.Lock()
+
+def obter_pool_etiquetas():
+    global pool_etiquetas
+    with pool_etiquetas_lock:
+        if pool_etiquetas is None:
+            # spawn: os filhos não herdam threads, locks nem conexões do servidor
+            pool_etiquetas = ProcessPoolExecutor(
+                max_workers=app.config['ETIQUETAS_PROCESSOS'],
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            # Sem isso os processos filhos só terminam quando o worker é morto
+            atexit.register(pool_etiquetas.shutdown, cancel_futures=True)
+        return pool_etiquetas
+
+def itens_etiquetas(categoria=None, alerta=None, id_inicio=None, id_fim=None, lote=1000):
+    """Gera (id, nome) dos materiais selecionados, lendo o banco em blocos por id."""
+    consulta = db.session.query(Material.id, Material.nome)
+    if categoria == 'sem':
+        consulta = consulta.filter(Material.categoria_id.is_(None))
+    elif categoria:
+        consulta = consulta.filter(Material.categoria_id == categoria)
+    if alerta in FILTROS_ALERTA:
+        consulta = consulta.filter(FILTROS_ALERTA[alerta])
+    if id_fim is not None:
+        consulta = consulta.filter(Material.id <= id_fim)
+    ultimo = (id_inicio - 1) if id_inicio else 0
+    while True:
+        bloco = consulta.filter(Material.id > ultimo).order_by(Material.id).limit(lote).all()
+        if not bloco:
+            return
+        yield from bloco
+        ultimo = bloco[-1][0]
+
+def paginas_etiquetas(itens, formato):
+    """Desenha as páginas no pool mantendo poucas em voo, na ordem original."""
+    import etiquetas  # traz qrcode e PIL; só quem imprime etiquetas paga por eles
+    layout = app.config['ETIQUETAS_LAYOUT']
+    por_pagina = dict(etiquetas.LAYOUT_PADRAO, **layout)
+    por_pagina = por_pagina['colunas'] * por_pagina['linhas']
+    grupos = (list(grupo) for grupo in lotes(itens, por_pagina))
+    argumentos = (app.config['QR_URL_BASE'], formato, layout)
+    processos = app.config['ETIQUETAS_PROCESSOS']
+    if not processos:
+        for grupo in grupos:
+            yield etiquetas.renderizar_pagina(grupo, *argumentos)
+        return
+    pool = obter_pool_etiquetas()
+    em_voo = deque()
+    for grupo in grupos:
+        em_voo.append(pool.submit(etiquetas.renderizar_pagina, grupo, *argumentos))
+        # Limita as páginas prontas em memória a ~2 por processo
+        if len(em_voo) >= 2 * processos:
+            yield em_voo.popleft().result()
+    while em_voo:
+        yield em_voo.popleft().result()
+
+def argumento_inteiro(nome):
+    valor = request.args.get(nome, '').strip()
+    return int(valor) if valor.isdigit() else None
+
+@app.route('/etiquetas')
+@login_required
+def etiquetas_form():
+    categorias = cache_categorias.listar()
+    return render_template('etiquetas.html', categorias=categorias)
+
+@app.route('/etiquetas/folhas.<any(pdf, zip):formato>')
+@login_required
+def etiquetas_folhas(formato):
+    categoria = request.args.get('categoria', '')
+    if categoria != 'sem' and not categoria.isdigit():
+        categoria = None
+    itens = itens_etiquetas(
+        categoria=categoria,
+        alerta=request.args.get('alerta'),
+        id_inicio=argumento_inteiro('id_inicio'),
+        id_fim=argumento_inteiro('id_fim'),
+    )
+    import etiquetas
+    if formato == 'pdf':
+        corpo = etiquetas.montar_pdf(paginas_etiquetas(itens, 'pdf'), app.config['ETIQUETAS_LAYOUT'])
+        tipo = 'application/pdf'
+    else:
+        corpo = etiquetas.montar_zip(paginas_etiquetas(itens, 'png'))
+        tipo = 'application/zip'
+    resposta = Response(stream_with_context(corpo), mimetype=tipo)
+    resposta.headers['Content-Disposition'] = f'attachment; filename=etiquetas.{formato}'
+    return resposta
+
 @app.route('/categorias')
 @login_required
 def categorias():
-    categorias = Categoria.query.order_by(Categoria.nome).all()
+    categorias = cache_categorias.listar()
     return render_template('categorias.html', categorias=categorias)
 
 @app.route('/categorias/adicionar', methods=['GET', 'POST'])
 @login_required
+@com_retentativa
 def adicionar_categoria():
     if request.method == 'POST':
         nome = request.form['nome'].strip()
@@ -222,16 +1744,1034 @@ def adicionar_categoria():
 
 @app.route('/categorias/remover/<int:id>', methods=['GET', 'POST'])
 @login_required
+@com_retentativa
 def remover_categoria(id):
     categoria = Categoria.query.get_or_404(id)
-    materiais = Material.query.filter_by(categoria_id=categoria.id).all()
-    for m in materiais:
-        m.categoria_id = None
+    # Um único UPDATE desliga todos os itens, sem carregá-los na sessão
+    tabela = Material.__table__
+    db.session.execute(tabela.update().where(tabela.c.categoria_id == categoria.id).values(categoria_id=None))
     db.session.delete(categoria)
     db.session.commit()
     flash('Categoria removida com sucesso! Os itens associados agora não possuem categoria.', 'success')
     return redirect(url_for('categorias'))
 
+# ===================================
+# Importação e exportação em massa (CSV / JSON Lines)
+# ===================================
+
+CAMPOS_MATERIAL = ['nome', 'descricao', 'quantidade', 'quantidade_alerta_requisicao',
+                   'quantidade_alerta_estoque', 'categoria']
+CAMPOS_CATEGORIA = ['nome']
+
+class LinhaInvalida(ValueError):
+    pass
+
+class ImportacaoInterrompida(Exception):
+    """O arquivo deixou de ser legível no meio; os lotes anteriores já foram gravados."""
+
+    def __init__(self, linha, motivo, importados, erros):
+        super().__init__(f'Linha {linha}: {motivo}')
+        self.linha = linha
+        self.motivo = motivo
+        self.importados = importados
+        self.erros = erros
+
+# 'auto' tenta UTF-8 em cada linha e, se não der, Windows-1252 (CSV do Excel em português)
+CODIFICACOES_IMPORTACAO = ('auto', 'utf-8', 'cp1252')
+
+class TextoImportacao:
+    """Decodifica um arquivo binário linha a linha, guardando o número da linha atual."""
+
+    def __init__(self, arquivo_binario, codificacao='auto'):
+        self.arquivo = arquivo_binario
+        self.codificacao = codificacao
+        self.linha = 0
+
+    def __iter__(self):
+        for bruta in self.arquivo:
+            self.linha += 1
+            if self.linha == 1 and bruta.startswith(codecs.BOM_UTF8):
+                bruta = bruta[len(codecs.BOM_UTF8):]
+            if self.codificacao != 'auto':
+                yield bruta.decode(self.codificacao)
+                continue
+            try:
+                yield bruta.decode('utf-8')
+            except UnicodeDecodeError:
+                yield bruta.decode('cp1252')
+
+def formato_do_arquivo(nome_arquivo):
+    extensao = os.path.splitext(nome_arquivo or '')[1].lower()
+    if extensao == '.csv':
+        return 'csv'
+    if extensao in ('.jsonl', '.json', '.ndjson'):
+        return 'jsonl'
+    return None
+
+def ler_linhas(arquivo_texto, formato):
+    """Gera (número da linha, dicionário) sem carregar o arquivo inteiro."""
+    if formato == 'csv':
+        leitor = csv.DictReader(arquivo_texto)
+        for linha in leitor:
+            yield leitor.line_num, linha
+    else:
+        for numero, texto in enumerate(arquivo_texto, start=1):
+            if not texto.strip():
+                continue
+            try:
+                linha = json.loads(texto)
+            except ValueError:
+                linha = None
+            yield numero, linha
+
+def inteiro_do_campo(linha, campo):
+    valor = linha.get(campo)
+    if valor is None or str(valor).strip() == '':
+        return 0
+    try:
+        valor = int(valor)
+    except (TypeError, ValueError):
+        raise LinhaInvalida(f'{campo} deve ser um número inteiro')
+    if valor < 0:
+        raise LinhaInvalida(f'{campo} não pode ser negativo')
+    return valor
+
+def validar_material(linha, categorias_por_nome):
+    if not isinstance(linha, dict):
+        raise LinhaInvalida('linha mal formatada')
+    nome = (linha.get('nome') or '').strip()
+    if not nome:
+        raise LinhaInvalida('nome é obrigatório')
+    if len(nome) > 100:
+        raise LinhaInvalida('nome com mais de 100 caracteres')
+    descricao = (linha.get('descricao') or '').strip()
+    if len(descricao) > 200:
+        raise LinhaInvalida('descrição com mais de 200 caracteres')
+    nome_categoria = (linha.get('categoria') or '').strip()
+    categoria_id = None
+    if nome_categoria:
+        categoria_id = categorias_por_nome.get(nome_categoria)
+        if categoria_id is None:
+            raise LinhaInvalida(f'categoria "{nome_categoria}" não existe')
+    return {
+        'nome': nome,
+        'descricao': descricao,
+        'quantidade': inteiro_do_campo(linha, 'quantidade'),
+        'quantidade_alerta_requisicao': inteiro_do_campo(linha, 'quantidade_alerta_requisicao'),
+        'quantidade_alerta_estoque': inteiro_do_campo(linha, 'quantidade_alerta_estoque'),
+        'categoria_id': categoria_id,
+    }
+
+def criar_categorias_faltantes(linhas, categorias_por_nome):
+    nomes = {(linha.get('categoria') or '').strip() for _, linha in linhas if isinstance(linha, dict)}
+    novas = [{'nome': nome} for nome in nomes
+             if nome and len(nome) <= 50 and nome not in categorias_por_nome]
+    if novas:
+        db.session.execute(Categoria.__table__.insert(), novas)
+        categorias_por_nome.update(mapa_categorias(nome for nome in nomes if nome))
+
+def mapa_categorias(nomes=None):
+    consulta = db.session.query(Categoria.nome, Categoria.id)
+    if nomes is not None:
+        consulta = consulta.filter(Categoria.nome.in_(list(nomes)))
+    return dict(consulta.all())
+
+def lotes(iteravel, tamanho):
+    lote = []
+    for item in iteravel:
+        lote.append(item)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def lotes_importacao(arquivo_texto, formato, tamanho_lote, progresso):
+    """Lotes de ler_linhas; se o arquivo ficar ilegível, desfaz o lote atual e avisa até onde foi.
+
+    `progresso` é a lista [importados, erros] que o chamador vai atualizando.
+    """
+    try:
+        yield from lotes(ler_linhas(arquivo_texto, formato), tamanho_lote)
+    except (UnicodeDecodeError, csv.Error) as erro:
+        db.session.rollback()
+        motivo = ('o arquivo não está na codificação escolhida (tente UTF-8 ou Windows-1252)'
+                  if isinstance(erro, UnicodeDecodeError) else f'CSV inválido ({erro})')
+        raise ImportacaoInterrompida(getattr(arquivo_texto, 'linha', '?'), motivo, *progresso)
+
+def importar_materiais(arquivo_texto, formato, tamanho_lote=None, criar_categorias=False, usuario_id=None):
+    """Importa materiais em lotes; cada lote é um único INSERT em executemany.
+
+    A quantidade de cada material entra no histórico como um 'ajuste' de
+    abertura, como faz o cadastro manual. Retorna (quantidade importada,
+    lista de (linha, erro)); levanta ImportacaoInterrompida se o arquivo
+    ficar ilegível (os lotes anteriores continuam gravados).
+    """
+    tamanho_lote = tamanho_lote or app.config['IMPORTACAO_LOTE']
+    categorias_por_nome = mapa_categorias()
+    progresso = [0, []]
+    for lote in lotes_importacao(arquivo_texto, formato, tamanho_lote, progresso):
+        if criar_categorias:
+            criar_categorias_faltantes(lote, categorias_por_nome)
+        registros = []
+        for numero, linha in lote:
+            try:
+                registros.append(validar_material(linha, categorias_por_nome))
+            except LinhaInvalida as erro:
+                progresso[1].append((numero, str(erro)))
+        if registros:
+            criados = db.session.execute(
+                Material.__table__.insert().returning(Material.id, Material.quantidade), registros).all()
+            agora = datetime.utcnow()
+            movimentacoes = [{'material_id': material_id, 'tipo': 'ajuste', 'quantidade': quantidade,
+                              'saldo': quantidade, 'usuario_id': usuario_id,
+                              'observacao': 'Estoque inicial (importação)', 'criado_em': agora}
+                             for material_id, quantidade in criados if quantidade]
+            if movimentacoes:
+                db.session.execute(Movimentacao.__table__.insert(), movimentacoes)
+        db.session.commit()
+        progresso[0] += len(registros)
+    return tuple(progresso)
+
+def importar_categorias(arquivo_texto, formato, tamanho_lote=None):
+    tamanho_lote = tamanho_lote or app.config['IMPORTACAO_LOTE']
+    existentes = set(mapa_categorias())
+    progresso = [0, []]
+    for lote in lotes_importacao(arquivo_texto, formato, tamanho_lote, progresso):
+        registros = []
+        for numero, linha in lote:
+            nome = (linha.get('nome') or '').strip() if isinstance(linha, dict) else ''
+            if not nome or len(nome) > 50:
+                progresso[1].append((numero, 'nome da categoria vazio ou com mais de 50 caracteres'))
+            elif nome not in existentes:
+                existentes.add(nome)
+                registros.append({'nome': nome})
+        if registros:
+            db.session.execute(Categoria.__table__.insert(), registros)
+        db.session.commit()
+        progresso[0] += len(registros)
+    return tuple(progresso)
+
+def linhas_exportacao(tipo):
+    """Percorre a tabela em blocos por chave, sem montar objetos ORM."""
+    if tipo == 'categorias':
+        colunas = (Categoria.id, Categoria.nome)
+        consulta = db.select(*colunas)
+        chave = Categoria.id
+    else:
+        colunas = (Material.id, Material.nome, Material.descricao, Material.quantidade,
+                   Material.quantidade_alerta_requisicao, Material.quantidade_alerta_estoque,
+                   Categoria.nome.label('categoria'))
+        consulta = db.select(*colunas).outerjoin(Categoria, Material.categoria_id == Categoria.id)
+        chave = Material.id
+    ultimo = 0
+    while True:
+        bloco = db.session.execute(
+            consulta.where(chave > ultimo).order_by(chave).limit(app.config['EXPORTACAO_LOTE'])
+        ).all()
+        if not bloco:
+            break
+        yield bloco
+        ultimo = bloco[-1][0]
+
+def gerar_exportacao(tipo, formato):
+    campos = ['id'] + (CAMPOS_CATEGORIA if tipo == 'categorias' else CAMPOS_MATERIAL)
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    if formato == 'csv':
+        escritor.writerow(campos)
+    for bloco in linhas_exportacao(tipo):
+        for linha in bloco:
+            if formato == 'csv':
+                escritor.writerow(linha)
+            else:
+                buffer.write(json.dumps(dict(zip(campos, linha)), ensure_ascii=False))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route('/importar', methods=['GET', 'POST'])
+@login_required
+def importar():
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        tipo = request.form.get('tipo', 'materiais')
+        formato = formato_do_arquivo(arquivo.filename if arquivo else None)
+        if not arquivo or not formato:
+            flash('Envie um arquivo .csv ou .jsonl.', 'danger')
+            return render_template('importar.html')
+        codificacao = request.form.get('codificacao', 'auto')
+        if codificacao not in CODIFICACOES_IMPORTACAO:
+            codificacao = 'auto'
+        # O upload grande já fica em arquivo temporário; lemos como texto em fluxo
+        texto = TextoImportacao(arquivo.stream, codificacao)
+        try:
+            if tipo == 'categorias':
+                importados, erros = importar_categorias(texto, formato)
+            else:
+                importados, erros = importar_materiais(
+                    texto, formato, criar_categorias='criar_categorias' in request.form,
+                    usuario_id=current_user.id)
+        except ImportacaoInterrompida as interrupcao:
+            flash(f'Importação interrompida na linha {interrupcao.linha}: {interrupcao.motivo}. '
+                  f'{interrupcao.importados} registro(s) dos lotes anteriores já foram gravados.', 'danger')
+            importados, erros = None, interrupcao.erros
+        if importados is not None:
+            flash(f'{importados} registro(s) importado(s).', 'success')
+        if erros:
+            flash(f'{len(erros)} linha(s) ignorada(s) por erro.', 'warning')
+            for numero, erro in erros[:20]:
+                flash(f'Linha {numero}: {erro}', 'warning')
+        return redirect(url_for('index'))
+    return render_template('importar.html')
+
+@app.route('/exportar/<any(materiais, categorias):tipo>.<any(csv, jsonl):formato>')
+@login_required
+def exportar(tipo, formato):
+    mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    resposta = Response(stream_with_context(gerar_exportacao(tipo, formato)),
+                        content_type=f'{mimetype}; charset=utf-8')
+    resposta.headers['Content-Disposition'] = f'attachment; filename={tipo}.{formato}'
+    return resposta
+
+@app.cli.command('importar')
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+@click.option('--tipo', type=click.Choice(['materiais', 'categorias']), default='materiais')
+@click.option('--lote', type=int, default=None, help='Linhas por transação.')
+@click.option('--criar-categorias', is_flag=True, help='Cria as categorias que não existirem.')
+@click.option('--codificacao', type=click.Choice(CODIFICACOES_IMPORTACAO), default='auto',
+              help="'auto' tenta UTF-8 e, linha a linha, Windows-1252.")
+def importar_comando(caminho, tipo, lote, criar_categorias, codificacao):
+    """Importa materiais ou categorias de um arquivo CSV ou JSON Lines."""
+    formato = formato_do_arquivo(caminho)
+    if not formato:
+        raise click.BadParameter('use um arquivo .csv ou .jsonl', param_hint='CAMINHO')
+    with open(caminho, 'rb') as arquivo:
+        texto = TextoImportacao(arquivo, codificacao)
+        try:
+            if tipo == 'categorias':
+                importados, erros = importar_categorias(texto, formato, lote)
+            else:
+                importados, erros = importar_materiais(texto, formato, lote, criar_categorias)
+        except ImportacaoInterrompida as interrupcao:
+            for numero, erro in interrupcao.erros:
+                click.echo(f'Linha {numero}: {erro}', err=True)
+            raise click.ClickException(
+                f'importação interrompida na linha {interrupcao.linha}: {interrupcao.motivo}. '
+                f'{interrupcao.importados} registro(s) dos lotes anteriores já foram gravados.')
+    for numero, erro in erros:
+        click.echo(f'Linha {numero}: {erro}', err=True)
+    click.echo(f'{importados} registro(s) importado(s), {len(erros)} linha(s) com erro.')
+
+@app.cli.command('exportar')
+@click.argument('caminho', type=click.Path(dir_okay=False, writable=True))
+@click.option('--tipo', type=click.Choice(['materiais', 'categorias']), default='materiais')
+def exportar_comando(caminho, tipo):
+    """Exporta materiais ou categorias para CSV ou JSON Lines (pela extensão)."""
+    formato = formato_do_arquivo(caminho)
+    if not formato:
+        raise click.BadParameter('use um arquivo .csv ou .jsonl', param_hint='CAMINHO')
+    with open(caminho, 'w', encoding='utf-8', newline='') as saida:
+        for pedaco in gerar_exportacao(tipo, formato):
+            saida.write(pedaco)
+
+# ===================================
+# Tarefas em segundo plano (fila persistente no SQLite)
+# ===================================
+
+# tipo -> função(parametros, progresso); registradas com @tarefa('tipo')
+TAREFAS = {}
+
+def tarefa(tipo):
+    def registrar(funcao):
+        TAREFAS[tipo] = funcao
+        return funcao
+    return registrar
+
+def enfileirar(tipo, parametros, max_tentativas=3, usuario_id=None):
+    """Adiciona a tarefa na sessão atual: entra na fila junto com o commit do chamador."""
+    nova = Tarefa(tipo=tipo, parametros=json.dumps(parametros), max_tentativas=max_tentativas,
+                  usuario_id=usuario_id)
+    db.session.add(nova)
+    return nova
+
+def tarefa_pronta():
+    """Só leitura: há tarefa pendente vencida? Evita o UPDATE de reivindicar_tarefa com a fila vazia."""
+    tabela = Tarefa.__table__
+    return db.session.execute(
+        db.select(tabela.c.id)
+        .where(tabela.c.situacao == 'pendente', tabela.c.executar_em <= datetime.utcnow())
+        .limit(1)).first() is not None
+
+def reivindicar_tarefa(trabalhador):
+    """Marca a próxima tarefa pendente como 'executando' num único UPDATE.
+
+    Vários processos podem chamar ao mesmo tempo: o SQLite serializa as
+    escritas e cada tarefa sai para um só trabalhador.
+    """
+    tabela = Tarefa.__table__
+    agora = datetime.utcnow()
+    proxima = (db.select(tabela.c.id)
+               .where(tabela.c.situacao == 'pendente', tabela.c.executar_em <= agora)
+               .order_by(tabela.c.executar_em, tabela.c.id).limit(1).scalar_subquery())
+    try:
+        linha = db.session.execute(
+            tabela.update().where(tabela.c.id == proxima, tabela.c.situacao == 'pendente')
+            .values(situacao='executando', trabalhador=trabalhador, iniciado_em=agora,
+                    tentativas=tabela.c.tentativas + 1)
+            .returning(tabela.c.id, tabela.c.tipo, tabela.c.parametros)
+        ).first()
+        db.session.commit()
+    except OperationalError as erro:
+        db.session.rollback()
+        if not banco_ocupado(erro):
+            raise
+        return None
+    return linha
+
+def manutencao_tarefas():
+    """Devolve à fila tarefas órfãs, apaga as antigas já encerradas e agenda o retrato diário."""
+    tabela = Tarefa.__table__
+    agora = datetime.utcnow()
+    db.session.execute(
+        tabela.update()
+        .where(tabela.c.situacao == 'executando',
+               tabela.c.iniciado_em < agora - timedelta(seconds=app.config['TAREFAS_TEMPO_LIMITE']))
+        .values(situacao='pendente', executar_em=agora, trabalhador=None))
+    antigas = db.session.execute(
+        tabela.delete()
+        .where(tabela.c.situacao.in_(('concluida', 'falhou')),
+               tabela.c.concluido_em < agora - timedelta(days=app.config['TAREFAS_RETENCAO_DIAS']))
+        .returning(tabela.c.resultado)).scalars().all()
+    agendar_estoque_diario()
+    db.session.commit()
+    for resultado in antigas:
+        arquivo = json.loads(resultado or '{}').get('arquivo')
+        if arquivo:
+            try:
+                os.remove(os.path.join(pasta_exportacoes(), arquivo))
+            except FileNotFoundError:
+                pass
+
+class Progresso:
+    """Passado às tarefas para informar o andamento; grava no máximo 2x por segundo."""
+
+    def __init__(self, tarefa_id):
+        self.tarefa_id = tarefa_id
+        self.ultimo = 0.0
+
+    def __call__(self, fracao, mensagem=None):
+        agora = time.monotonic()
+        if agora - self.ultimo < 0.5 and fracao < 1:
+            return
+        self.ultimo = agora
+        tabela = Tarefa.__table__
+        valores = {'progresso': max(0.0, min(1.0, fracao))}
+        if mensagem is not None:
+            valores['mensagem'] = mensagem[:200]
+        try:
+            # Conexão própria: não mistura com a transação da tarefa
+            with db.engine.begin() as conexao:
+                conexao.execute(tabela.update().where(tabela.c.id == self.tarefa_id).values(**valores))
+        except OperationalError as erro:
+            # Progresso é informativo: banco ocupado não derruba a tarefa
+            if not banco_ocupado(erro):
+                raise
+
+def executar_tarefa(tarefa_id, tipo, parametros):
+    tabela = Tarefa.__table__
+    inicio = time.perf_counter()
+    try:
+        funcao = TAREFAS.get(tipo)
+        if funcao is None:
+            raise LookupError(f'tipo de tarefa desconhecido: {tipo}')
+        resultado = funcao(json.loads(parametros), Progresso(tarefa_id))
+        valores = {'situacao': 'concluida', 'progresso': 1.0, 'concluido_em': datetime.utcnow(),
+                   'resultado': json.dumps(resultado) if resultado is not None else None, 'erro': None}
+        situacao = 'concluida'
+    except Exception as erro:
+        db.session.rollback()
+        app.logger.exception('Tarefa %s (%s) falhou', tarefa_id, tipo)
+        tentativas, maximo = db.session.execute(
+            db.select(tabela.c.tentativas, tabela.c.max_tentativas).where(tabela.c.id == tarefa_id)).one()
+        if tentativas < maximo:
+            espera = app.config['TAREFAS_ESPERA_BASE'] * (2 ** (tentativas - 1))
+            valores = {'situacao': 'pendente', 'trabalhador': None,
+                       'executar_em': datetime.utcnow() + timedelta(seconds=espera)}
+        else:
+            valores = {'situacao': 'falhou', 'concluido_em': datetime.utcnow()}
+        valores['erro'] = f'{type(erro).__name__}: {erro}'[:2000]
+        situacao = valores['situacao']
+    db.session.execute(tabela.update().where(tabela.c.id == tarefa_id).values(**valores))
+    db.session.commit()
+    metricas.contar('inventario_tarefas_total', ajuda='Tarefas em segundo plano executadas.',
+                    tipo=tipo, situacao=situacao)
+    metricas.observar('inventario_tarefa_segundos', time.perf_counter() - inicio,
+                      'Duração das tarefas em segundo plano.', tipo=tipo)
+
+class ExecutorTarefas:
+    """Consome a fila com um pool de threads, dentro do worker web ou no `flask trabalhador`."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.acordar = threading.Event()
+        self.nome = f'{socket.gethostname()}:{os.getpid()}'
+
+    def iniciar(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            # O pid muda depois do fork (gunicorn): o nome identifica este processo
+            self.nome = f'{socket.gethostname()}:{os.getpid()}'
+            self.thread = threading.Thread(target=self.laco, name='executor-tarefas', daemon=True)
+            self.thread.start()
+
+    def avisar(self):
+        self.acordar.set()
+
+    def executar(self, tarefa_id, tipo, parametros):
+        with app.app_context():
+            executar_tarefa(tarefa_id, tipo, parametros)
+
+    def laco(self, ate_esvaziar=False):
+        trabalhadores = max(1, app.config['TAREFAS_TRABALHADORES'])
+        vagas = threading.BoundedSemaphore(trabalhadores)
+        proxima_manutencao = 0.0
+        with ThreadPoolExecutor(max_workers=trabalhadores, thread_name_prefix='tarefa') as pool:
+            while True:
+                vagas.acquire()
+                try:
+                    with app.app_context():
+                        if time.monotonic() >= proxima_manutencao:
+                            manutencao_tarefas()
+                            proxima_manutencao = time.monotonic() + 60
+                        # Com a fila vazia, cada worker só lê (WAL): nenhuma escrita a cada intervalo
+                        linha = reivindicar_tarefa(self.nome) if tarefa_pronta() else None
+                except Exception:
+                    app.logger.exception('Erro consultando a fila de tarefas')
+                    linha = None
+                if linha is None:
+                    vagas.release()
+                    if ate_esvaziar:
+                        # Espera as que estão rodando aqui: uma falha pode reagendá-las
+                        for _ in range(trabalhadores):
+                            vagas.acquire()
+                        for _ in range(trabalhadores):
+                            vagas.release()
+                        with app.app_context():
+                            if not tarefa_pronta():
+                                return
+                        continue
+                    self.acordar.wait(app.config['TAREFAS_INTERVALO'])
+                    self.acordar.clear()
+                    continue
+                pool.submit(self.executar, *linha).add_done_callback(lambda _: vagas.release())
+
+executor_tarefas = ExecutorTarefas()
+
+@app.before_request
+def iniciar_executor_tarefas():
+    if app.config['TAREFAS_EXECUTOR'] == 'processo':
+        executor_tarefas.iniciar()
+
+def pasta_exportacoes():
+    pasta = os.path.join(app.instance_path, 'exportacoes')
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+@tarefa('qr_gerar')
+def tarefa_qr_gerar(parametros, progresso):
+    ids = parametros['material_ids']
+    for posicao, material_id in enumerate(ids, start=1):
+        for formato in parametros.get('formatos', ['png']):
+            cache_qr.obter(material_id, formato, existe=material_existe)
+        progresso(posicao / len(ids))
+
+@tarefa('qr_apagar')
+def tarefa_qr_apagar(parametros, progresso):
+    cache_qr.apagar_arquivos(parametros['material_ids'])
+
+@tarefa('exportar')
+def tarefa_exportar(parametros, progresso):
+    tipo, formato = parametros['tipo'], parametros['formato']
+    modelo = Categoria if tipo == 'categorias' else Material
+    total = db.session.query(modelo).count() or 1
+    arquivo = f"{tipo}_{parametros['tarefa_id']}.{formato}"
+    caminho = os.path.join(pasta_exportacoes(), arquivo)
+    temporario = caminho + '.tmp'
+    linhas = 0
+    with open(temporario, 'w', encoding='utf-8', newline='') as saida:
+        for pedaco in gerar_exportacao(tipo, formato):
+            saida.write(pedaco)
+            linhas += pedaco.count('\n')
+            progresso(min(linhas / total, 0.99), f'{linhas} linha(s)')
+    os.replace(temporario, caminho)
+    progresso(1.0, f'{linhas} linha(s) exportada(s)')
+    return {'arquivo': arquivo, 'linhas': linhas}
+
+def tarefa_visivel(id):
+    tarefa_atual = Tarefa.query.get_or_404(id)
+    if not current_user.is_admin and tarefa_atual.usuario_id != current_user.id:
+        abort(404)
+    return tarefa_atual
+
+def tarefa_json(tarefa_atual):
+    return {
+        'id': tarefa_atual.id,
+        'tipo': tarefa_atual.tipo,
+        'situacao': tarefa_atual.situacao,
+        'progresso': tarefa_atual.progresso,
+        'mensagem': tarefa_atual.mensagem,
+        'tentativas': tarefa_atual.tentativas,
+        'erro': tarefa_atual.erro,
+        'resultado': json.loads(tarefa_atual.resultado) if tarefa_atual.resultado else None,
+    }
+
+@app.route('/exportar/<any(materiais, categorias):tipo>.<any(csv, jsonl):formato>/tarefa', methods=['POST'])
+@login_required
+@com_retentativa
+def exportar_em_segundo_plano(tipo, formato):
+    nova = enfileirar('exportar', {'tipo': tipo, 'formato': formato}, usuario_id=current_user.id)
+    db.session.flush()
+    # O nome do arquivo usa o id, que só existe depois do flush
+    nova.parametros = json.dumps({'tipo': tipo, 'formato': formato, 'tarefa_id': nova.id})
+    db.session.commit()
+    executor_tarefas.avisar()
+    return redirect(url_for('tarefa_status', id=nova.id))
+
+@app.route('/tarefas/<int:id>')
+@login_required
+def tarefa_status(id):
+    return render_template('tarefa.html', tarefa=tarefa_visivel(id))
+
+@app.route('/tarefas/<int:id>.json')
+@login_required
+def tarefa_status_json(id):
+    return jsonify(tarefa_json(tarefa_visivel(id)))
+
+@app.route('/tarefas/<int:id>/arquivo')
+@login_required
+def tarefa_arquivo(id):
+    tarefa_atual = tarefa_visivel(id)
+    resultado = json.loads(tarefa_atual.resultado or '{}')
+    if tarefa_atual.situacao != 'concluida' or not resultado.get('arquivo'):
+        abort(404)
+    return send_from_directory(pasta_exportacoes(), resultado['arquivo'], as_attachment=True)
+
+@app.cli.command('trabalhador')
+@click.option('--ate-esvaziar', is_flag=True, help='Sai quando não houver mais tarefas prontas.')
+def trabalhador_comando(ate_esvaziar):
+    """Executa as tarefas em segundo plano neste processo (use com TAREFAS_EXECUTOR=externo)."""
+    executor_tarefas.laco(ate_esvaziar=ate_esvaziar)
+
+# ===================================
+# Histórico diário de estoque e relatórios de consumo
+# ===================================
+
+# Um único INSERT ... SELECT por dia: só entram os materiais novos ou cuja
+# quantidade mudou desde o último registro; o acumulado soma a queda (se houve).
+SQL_ESTOQUE_DIARIO = """
+INSERT INTO estoque_diario (material_id, data, quantidade, consumo_acumulado)
+SELECT m.id, :data, coalesce(m.quantidade, 0),
+       coalesce(a.consumo_acumulado, 0) + max(coalesce(a.quantidade, 0) - coalesce(m.quantidade, 0), 0)
+FROM material m
+LEFT JOIN estoque_diario a ON a.material_id = m.id AND a.data = (
+    SELECT max(e.data) FROM estoque_diario e WHERE e.material_id = m.id AND e.data < :data)
+WHERE a.material_id IS NULL OR a.quantidade != coalesce(m.quantidade, 0)
+"""
+
+def registrar_estoque_diario(data=None):
+    """Grava o retrato do dia (refazendo-o se já existir). Não faz commit."""
+    data = (data or date.today()).isoformat()
+    tabela = EstoqueDiario.__table__
+    db.session.execute(tabela.delete().where(tabela.c.data == data))
+    return db.session.execute(db.text(SQL_ESTOQUE_DIARIO), {'data': data}).rowcount
+
+def agendar_estoque_diario():
+    # O UPDATE condicional garante uma só tarefa por dia, mesmo com vários workers
+    hoje = date.today().toordinal()
+    tabela = VersaoDados.__table__
+    agendado = db.session.execute(
+        tabela.update().where(tabela.c.nome == 'estoque_diario', tabela.c.versao < hoje)
+        .values(versao=hoje, alterado_em=datetime.utcnow())).rowcount
+    if agendado:
+        enfileirar('estoque_diario', {'data': date.today().isoformat()})
+
+def atualizar_consumo(hoje=None):
+    """Recalcula consumo_material para todas as janelas (RELATORIO_JANELAS). Não faz commit."""
+    hoje = (hoje or date.today()).isoformat()
+    janelas = ', '.join(f'({int(dias)})' for dias in app.config['RELATORIO_JANELAS'])
+    db.session.execute(ConsumoMaterial.__table__.delete())
+    db.session.execute(db.text(SQL_CONSUMO.format(janelas=janelas)), {'hoje': hoje})
+    tabela = VersaoDados.__table__
+    db.session.execute(sqlite_insert(tabela)
+                       .values(nome='consumo_material', versao=date.fromisoformat(hoje).toordinal(),
+                               alterado_em=datetime.utcnow())
+                       .on_conflict_do_update(index_elements=['nome'],
+                                              set_={'versao': date.fromisoformat(hoje).toordinal(),
+                                                    'alterado_em': datetime.utcnow()}))
+
+@tarefa('estoque_diario')
+def tarefa_estoque_diario(parametros, progresso):
+    # O retrato copia a quantidade atual: uma tarefa que atrasou até o dia seguinte
+    # grava o dia em que rodou, não o dia em que foi agendada
+    data = date.today()
+    gravados = registrar_estoque_diario(data)
+    # O progresso é gravado por outra conexão: com a transação do retrato ainda
+    # aberta, ele esperaria o lock desta mesma tarefa até o busy_timeout
+    db.session.commit()
+    progresso(0.5, 'Retrato gravado; calculando o consumo')
+    atualizar_consumo(data)
+    db.session.commit()
+    return {'materiais': gravados}
+
+# Resumo de consumo por material e janela, recalculado uma vez por dia junto
+# com o retrato: o relatório só lê esta tabela. Para cada material bastam
+# buscas pela chave (material_id, data) — acumulado mais recente, primeiro
+# registro e acumulado no início de cada janela —, então o custo depende do
+# número de materiais, não de quantos dias de histórico existem. MATERIALIZED
+# impede o SQLite de repetir as subconsultas em cada expressão que as usa.
+SQL_CONSUMO = """
+WITH janelas(dias) AS (VALUES {janelas}),
+base AS MATERIALIZED (
+    SELECT m.id, m.categoria_id, coalesce(m.quantidade, 0) AS quantidade,
+           (SELECT e.consumo_acumulado FROM estoque_diario e
+             WHERE e.material_id = m.id AND e.data <= :hoje ORDER BY e.data DESC LIMIT 1) AS acumulado_fim,
+           (SELECT e.data FROM estoque_diario e
+             WHERE e.material_id = m.id ORDER BY e.data LIMIT 1) AS primeira_data
+    FROM material m
+),
+por_janela AS MATERIALIZED (
+    SELECT janelas.dias AS janela, base.*, date(:hoje, '-' || janelas.dias || ' days') AS inicio,
+           (SELECT e.consumo_acumulado FROM estoque_diario e
+             WHERE e.material_id = base.id AND e.data <= date(:hoje, '-' || janelas.dias || ' days')
+             ORDER BY e.data DESC LIMIT 1) AS acumulado_inicio
+    FROM janelas, base
+    WHERE base.acumulado_fim IS NOT NULL
+),
+consumo AS (
+    SELECT janela, id, categoria_id, quantidade,
+           acumulado_fim - coalesce(acumulado_inicio, 0) AS consumo,
+           max(1, julianday(:hoje) - julianday(max(primeira_data, inicio))) AS dias
+    FROM por_janela
+)
+INSERT INTO consumo_material (janela, material_id, categoria_id, quantidade, consumo, dias, taxa,
+                              dias_ate_ruptura, participacao_categoria)
+SELECT janela, id, categoria_id, quantidade, consumo, dias, consumo * 1.0 / dias,
+       CASE WHEN consumo > 0 THEN quantidade * dias / consumo END,
+       consumo * 1.0 / nullif(sum(consumo) OVER (PARTITION BY janela, categoria_id), 0)
+FROM consumo
+"""
+
+def filtro_categoria(consulta, coluna, categoria):
+    if categoria == 'sem':
+        return consulta.where(coluna.is_(None))
+    if categoria:
+        return consulta.where(coluna == int(categoria))
+    return consulta
+
+def relatorio_consumo(janela, categoria=None):
+    """(materiais, categorias) da janela: consumo, dias até a ruptura e sugestões de alerta.
+
+    Os materiais vêm em ordem de ruptura pelo índice (janela, dias_ate_ruptura);
+    as sugestões usam prazo de reposição e estoque de segurança atuais.
+    """
+    c = ConsumoMaterial.__table__.c
+    prazo = app.config['RELATORIO_PRAZO_REPOSICAO_DIAS']
+    seguranca = app.config['RELATORIO_DIAS_SEGURANCA']
+    # Teto de x: cast(x) + (x > cast(x)), sem depender das funções matemáticas opcionais do SQLite
+    def teto(x):
+        return db.cast(x, db.Integer) + db.cast(x > db.cast(x, db.Integer), db.Integer)
+    materiais = db.select(
+        c.material_id.label('id'), Material.nome, c.categoria_id, c.quantidade, c.consumo, c.dias, c.taxa,
+        c.dias_ate_ruptura, c.participacao_categoria,
+        db.func.coalesce(Material.quantidade_alerta_requisicao, 0).label('alerta_requisicao'),
+        db.func.coalesce(Material.quantidade_alerta_estoque, 0).label('alerta_estoque'),
+        teto(c.taxa * seguranca).label('sugestao_estoque'),
+        teto(c.taxa * (prazo + seguranca)).label('sugestao_requisicao'),
+    ).join(Material, Material.id == c.material_id).where(c.janela == janela, c.dias_ate_ruptura.is_not(None))
+    materiais = filtro_categoria(materiais, c.categoria_id, categoria)
+    materiais = materiais.order_by(c.dias_ate_ruptura, c.material_id).limit(app.config['RELATORIO_LIMITE'])
+    categorias = db.select(
+        c.categoria_id, db.func.coalesce(Categoria.nome, 'Sem categoria').label('nome'),
+        db.func.count().label('materiais'), db.func.sum(c.quantidade).label('quantidade'),
+        db.func.sum(c.consumo).label('consumo'), db.func.sum(c.taxa).label('taxa'),
+        db.func.sum(db.cast(c.dias_ate_ruptura < prazo, db.Integer)).label('em_risco'),
+    ).outerjoin(Categoria, Categoria.id == c.categoria_id).where(c.janela == janela)
+    categorias = filtro_categoria(categorias, c.categoria_id, categoria)
+    categorias = categorias.group_by(c.categoria_id).order_by(db.text('em_risco DESC'), db.text('consumo DESC'))
+    return db.session.execute(materiais).all(), db.session.execute(categorias).all()
+
+def serie_estoque(material_id, janela=None):
+    """Quantidade por dia registrado e a variação em relação ao registro anterior (LAG)."""
+    inicio = date.today() - timedelta(days=janela or app.config['RELATORIO_JANELA_DIAS'])
+    return db.session.execute(db.text("""
+        SELECT data, quantidade, variacao FROM (
+            SELECT data, quantidade, quantidade - lag(quantidade) OVER (ORDER BY data) AS variacao
+            FROM estoque_diario WHERE material_id = :material_id
+        ) WHERE data >= :inicio ORDER BY data
+    """), {'material_id': material_id, 'inicio': inicio.isoformat()}).all()
+
+@app.route('/relatorios')
+@login_required
+def relatorios():
+    janela = request.args.get('janela', app.config['RELATORIO_JANELA_DIAS'], type=int)
+    if janela not in app.config['RELATORIO_JANELAS']:
+        janela = app.config['RELATORIO_JANELA_DIAS']
+    categoria = request.args.get('categoria', '')
+    if categoria != 'sem' and not categoria.isdigit():
+        categoria = ''
+    materiais, por_categoria = relatorio_consumo(janela, categoria)
+    categorias = cache_categorias.listar()
+    calculo = versao_dados('consumo_material')
+    return render_template('relatorios.html', materiais=materiais, por_categoria=por_categoria,
+                           categorias=categorias, nomes_categorias={c.id: c.nome for c in categorias},
+                           calculado_em=calculo.alterado_em if calculo else None,
+                           filtros={'janela': janela, 'categoria': categoria})
+
+@app.route('/relatorios/material/<int:id>.json')
+@login_required
+def relatorio_material_json(id):
+    janela = max(7, min(request.args.get('janela', app.config['RELATORIO_JANELA_DIAS'], type=int), 3650))
+    return jsonify({
+        'material_id': id,
+        'serie': [{'data': str(linha.data), 'quantidade': linha.quantidade, 'variacao': linha.variacao}
+                  for linha in serie_estoque(id, janela)],
+    })
+
+@app.cli.command('estoque-diario')
+@click.option('--data', help='Data do retrato (AAAA-MM-DD); só é aceita a de hoje, que é o padrão.')
+def estoque_diario_comando(data):
+    """Grava o retrato diário do estoque e recalcula o consumo (para rodar pelo cron, se preferir)."""
+    if data:
+        try:
+            data = date.fromisoformat(data)
+        except ValueError:
+            raise click.BadParameter('use o formato AAAA-MM-DD', param_hint='--data')
+        # O retrato copia a quantidade atual: gravá-lo com outra data falsearia a série
+        if data != date.today():
+            raise click.BadParameter('o retrato só pode ser gravado com a data de hoje', param_hint='--data')
+    gravados = registrar_estoque_diario(data)
+    atualizar_consumo(data)
+    db.session.commit()
+    click.echo(f'{gravados} material(is) com quantidade nova registrada.')
+
+# ===================================
+# API JSON para os coletores (leitura de QR Code e sincronização offline)
+# ===================================
+
+# Cada escrita em material ganha o próximo número da sequência; REPLACE mantém
+# só a alteração mais recente de cada material. Os materiais que já existiam
+# são numerados uma vez, no atualizar_esquema.
+SQL_ALTERACOES_MATERIAL = [
+    f"""CREATE TRIGGER IF NOT EXISTS material_alteracao_{evento.lower()} AFTER {evento} ON material BEGIN
+        INSERT OR REPLACE INTO material_alteracao (material_id, versao, removido)
+        VALUES ({linha}.id, (SELECT coalesce(max(versao), 0) + 1 FROM material_alteracao), {removido});
+    END"""
+    for evento, linha, removido in (('INSERT', 'new', 0), ('UPDATE', 'new', 0), ('DELETE', 'old', 1))
+] + [
+    """INSERT INTO material_alteracao (material_id, versao, removido)
+    SELECT material.id, base.versao + material.id, 0
+    FROM material, (SELECT coalesce(max(versao), 0) AS versao FROM material_alteracao) AS base
+    WHERE NOT EXISTS (SELECT 1 FROM material_alteracao WHERE material_id = material.id)""",
+]
+
+COLUNAS_API = ('id', 'nome', 'descricao', 'quantidade', 'quantidade_alerta_requisicao',
+               'quantidade_alerta_estoque', 'categoria_id', 'alerta')
+
+def colunas_api():
+    return [Material.__table__.c[nome] for nome in COLUNAS_API]
+
+def material_api(linha):
+    return {nome: getattr(linha, nome) for nome in COLUNAS_API}
+
+def api_login_required(view):
+    # Cliente da API recebe 401 em JSON, não o redirecionamento para a tela de login
+    @wraps(view)
+    def protegida(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify({'erro': 'Autenticação necessária.'}), 401
+        return view(*args, **kwargs)
+    return protegida
+
+def ids_da_requisicao():
+    ids = []
+    for valor in request.args.getlist('ids'):
+        ids.extend(int(parte) for parte in valor.split(',') if parte.strip().isdigit())
+    return list(dict.fromkeys(ids))
+
+def alteracoes_desde(desde, limite):
+    """Materiais alterados depois da versão `desde`, em ordem de versão.
+
+    Retorna o dicionário da resposta: `versao` é o ponto para a próxima
+    chamada e `mais` indica que o limite foi atingido.
+    """
+    tabela = Material.__table__
+    alteracao = AlteracaoMaterial.__table__
+    linhas = db.session.execute(
+        db.select(alteracao.c.versao, alteracao.c.material_id, *colunas_api())
+        .select_from(alteracao.outerjoin(tabela, tabela.c.id == alteracao.c.material_id))
+        .where(alteracao.c.versao > desde)
+        .order_by(alteracao.c.versao)
+        .limit(limite + 1)
+    ).all()
+    mais = len(linhas) > limite
+    linhas = linhas[:limite]
+    materiais, removidos = [], []
+    for linha in linhas:
+        if linha.id is None:
+            removidos.append(linha.material_id)
+        else:
+            materiais.append(material_api(linha))
+    if linhas:
+        versao = linhas[-1].versao
+    else:
+        versao = max(desde, db.session.execute(db.select(db.func.max(alteracao.c.versao))).scalar() or 0)
+    return {'versao': versao, 'mais': mais, 'materiais': materiais, 'removidos': removidos}
+
+def validar_operacao(operacao):
+    """Retorna (id, material_id, tipo, quantidade, observacao) ou levanta LinhaInvalida."""
+    if not isinstance(operacao, dict):
+        raise LinhaInvalida('operação deve ser um objeto')
+    op_id = operacao.get('id')
+    if not isinstance(op_id, str) or not 0 < len(op_id) <= 64:
+        raise LinhaInvalida('id da operação ausente ou com mais de 64 caracteres')
+    tipo = operacao.get('tipo')
+    quantidade = operacao.get('quantidade')
+    material_id = operacao.get('material_id')
+    # bool é subclasse de int: true/false não podem passar por 1/0
+    if (type(material_id) is not int or tipo not in TIPOS_MOVIMENTACAO
+            or type(quantidade) is not int):
+        raise LinhaInvalida('informe material_id, tipo (entrada, saida ou ajuste) e quantidade inteira')
+    if quantidade < 0 or (quantidade == 0 and tipo != 'ajuste'):
+        raise LinhaInvalida('quantidade deve ser maior que zero (ou >= 0 no ajuste)')
+    observacao = operacao.get('observacao')
+    observacao = str(observacao)[:200] if observacao else None
+    return op_id, material_id, tipo, quantidade, observacao
+
+def aplicar_operacao(material_id, tipo, quantidade, usuario_id, observacao):
+    try:
+        if tipo == 'ajuste':
+            saldo = ajustar_estoque(material_id, quantidade, usuario_id, observacao)
+        else:
+            delta = quantidade if tipo == 'entrada' else -quantidade
+            saldo = movimentar_estoque(material_id, tipo, delta, usuario_id, observacao)
+    except EstoqueInsuficiente as erro:
+        return {'status': 'erro', 'erro': str(erro)}
+    except NotFound:
+        return {'status': 'erro', 'erro': 'Material não encontrado.'}
+    # Nos dois erros acima nada foi gravado: o UPDATE/INSERT ... SELECT não afetou linhas
+    return {'status': 'ok', 'material_id': material_id, 'quantidade': saldo}
+
+def aplicar_operacoes(operacoes, usuario_id):
+    """Aplica o lote numa única transação; operações já vistas devolvem o resultado original.
+
+    O id da operação é gravado antes de aplicá-la (INSERT ... ON CONFLICT DO
+    NOTHING): um reenvio concorrente do mesmo lote espera o lock de escrita
+    e encontra a operação já registrada.
+    """
+    tabela = OperacaoCliente.__table__
+    limite = datetime.utcnow() - timedelta(days=app.config['API_OPERACOES_RETENCAO_DIAS'])
+    db.session.execute(tabela.delete().where(tabela.c.criado_em < limite))
+    resultados = []
+    for operacao in operacoes:
+        try:
+            op_id, material_id, tipo, quantidade, observacao = validar_operacao(operacao)
+        except LinhaInvalida as erro:
+            op_id = operacao.get('id') if isinstance(operacao, dict) else None
+            resultados.append({'id': op_id, 'status': 'invalida', 'erro': str(erro)})
+            continue
+        nova = db.session.execute(
+            sqlite_insert(tabela)
+            .values(id=op_id, usuario_id=usuario_id, resultado='{}', criado_em=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=['usuario_id', 'id'])
+        ).rowcount
+        if not nova:
+            resultado = json.loads(db.session.execute(
+                db.select(tabela.c.resultado)
+                .where(tabela.c.usuario_id == usuario_id, tabela.c.id == op_id)).scalar())
+            resultados.append(dict(resultado, id=op_id, repetida=True))
+            continue
+        resultado = aplicar_operacao(material_id, tipo, quantidade, usuario_id, observacao)
+        db.session.execute(tabela.update()
+                           .where(tabela.c.usuario_id == usuario_id, tabela.c.id == op_id)
+                           .values(resultado=json.dumps(resultado)))
+        resultados.append(dict(resultado, id=op_id))
+    return resultados
+
+@app.route('/api/login', methods=['POST'])
+def api_login():
+    if not tentativa_permitida():
+        return jsonify({'erro': 'Muitas tentativas de login.'}), 429
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return jsonify({'erro': 'Envie um objeto JSON.'}), 400
+    user = User.query.filter_by(username=str(dados.get('username', ''))).first()
+    if not user or not user.check_password(str(dados.get('password', ''))):
+        registrar_tentativa()
+        return jsonify({'erro': 'Usuário ou senha inválidos.'}), 401
+    if not user.approved:
+        return jsonify({'erro': 'Registro aguardando autorização do administrador.'}), 403
+    login_user(user, remember=bool(dados.get('lembrar')))
+    return jsonify({'usuario': user.username})
+
+@app.route('/api/materiais/<int:id>')
+@api_login_required
+def api_material(id):
+    linha = db.session.execute(db.select(*colunas_api()).where(Material.__table__.c.id == id)).first()
+    if linha is None:
+        return jsonify({'erro': 'Material não encontrado.'}), 404
+    return jsonify(material_api(linha))
+
+@app.route('/api/materiais')
+@api_login_required
+def api_materiais():
+    # /api/materiais?ids=1,2,3 (ou ids repetido): uma consulta para todos os QR Codes lidos
+    ids = ids_da_requisicao()
+    if not ids or len(ids) > app.config['API_IDS_MAX']:
+        return jsonify({'erro': f"Informe de 1 a {app.config['API_IDS_MAX']} ids."}), 400
+    linhas = db.session.execute(db.select(*colunas_api()).where(Material.__table__.c.id.in_(ids))).all()
+    encontrados = {linha.id: material_api(linha) for linha in linhas}
+    return jsonify({
+        'materiais': [encontrados[i] for i in ids if i in encontrados],
+        'nao_encontrados': [i for i in ids if i not in encontrados],
+    })
+
+@app.route('/api/alteracoes')
+@api_login_required
+def api_alteracoes():
+    desde = max(0, request.args.get('desde', 0, type=int))
+    limite = request.args.get('limite', app.config['API_ALTERACOES_LIMITE'], type=int)
+    limite = max(1, min(limite, app.config['API_ALTERACOES_LIMITE']))
+    return jsonify(alteracoes_desde(desde, limite))
+
+@app.route('/api/sincronizar', methods=['POST'])
+@api_login_required
+@com_retentativa
+def api_sincronizar():
+    """Uma ida e volta por sessão de sincronização do coletor.
+
+    Corpo: {"operacoes": [{"id", "material_id", "tipo", "quantidade", "observacao"}],
+    "desde": N}. Aplica as operações e devolve os resultados junto com as
+    alterações desde a versão N (incluindo as que o próprio lote causou).
+    """
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return jsonify({'erro': 'Envie um objeto JSON.'}), 400
+    operacoes = dados.get('operacoes') or []
+    if not isinstance(operacoes, list) or len(operacoes) > app.config['API_OPERACOES_MAX']:
+        return jsonify({'erro': f"operacoes deve ser uma lista com até {app.config['API_OPERACOES_MAX']} itens."}), 400
+    resultados = aplicar_operacoes(operacoes, current_user.id)
+    db.session.commit()
+    resposta = {'resultados': resultados}
+    desde = dados.get('desde')
+    if isinstance(desde, int) and desde >= 0:
+        resposta['alteracoes'] = alteracoes_desde(desde, app.config['API_ALTERACOES_LIMITE'])
+    return jsonify(resposta)
+
 # ===================================
 # Rotas de Autenticação
 # ===================================
@@ -241,6 +2781,9 @@ def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     if request.method == 'POST':
+        if not tentativa_permitida():
+            flash('Muitas tentativas de login. Aguarde um minuto e tente novamente.', 'danger')
+            return render_template('login.html'), 429
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
@@ -248,11 +2791,16 @@ def login():
             if not user.approved:
                 flash('Seu registro está aguardando autorização do administrador.', 'warning')
                 return redirect(url_for('login'))
+            if not user.password_hash.startswith(app.config['SENHA_METODO'] + '$'):
+                # Senha gravada com outro método/custo: refaz com o configurado
+                user.set_password(password)
+                db.session.commit()
             login_user(user)
             flash('Login efetuado com sucesso!', 'success')
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('index'))
         else:
+            registrar_tentativa()
             flash('Nome de usuário ou senha inválidos.', 'danger')
     return render_template('login.html')
 
@@ -264,10 +2812,15 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/register', methods=['GET', 'POST'])
+@com_retentativa
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     if request.method == 'POST':
+        if not tentativa_permitida():
+            flash('Muitas tentativas. Aguarde um minuto e tente novamente.', 'danger')
+            return render_template('register.html'), 429
+        registrar_tentativa()
         username = request.form['username']
         password = request.form['password']
         confirm_password = request.form['confirm_password']
@@ -297,6 +2850,7 @@ def admin_pending():
 
 @app.route('/admin/approve/<int:user_id>', methods=['POST'])
 @login_required
+@com_retentativa
 def admin_approve(user_id):
     if not current_user.is_admin:
         flash('Você não tem permissão para realizar essa ação.', 'danger')
@@ -304,11 +2858,13 @@ def admin_approve(user_id):
     user = User.query.get_or_404(user_id)
     user.approved = True
     db.session.commit()
+    invalidar_usuario(user_id)
     flash(f'O usuário {user.username} foi aprovado.', 'success')
     return redirect(url_for('admin_pending'))
 
 @app.route('/admin/reject/<int:user_id>', methods=['POST'])
 @login_required
+@com_retentativa
 def admin_reject(user_id):
     if not current_user.is_admin:
         flash('Você não tem permissão para realizar essa ação.', 'danger')
@@ -316,21 +2872,85 @@ def admin_reject(user_id):
     user = User.query.get_or_404(user_id)
     db.session.delete(user)
     db.session.commit()
+    invalidar_usuario(user_id)
     flash(f'O usuário {user.username} foi rejeitado e removido.', 'info')
     return redirect(url_for('admin_pending'))
 
+# ===================================
+# Fábrica da aplicação
+# ===================================
+
+criacao_lock = threading.Lock()
+
+def criar_app(configuracao=None):
+    """Liga as extensões ao app, prepara os caches e retorna o app pronto para servir.
+
+    Importar este módulo não abre o banco, não cria pastas e não carrega
+    qrcode/PIL: isso fica para cá ou para o primeiro uso. `configuracao`
+    sobrescreve chaves de app.config e só vale na primeira chamada; as
+    seguintes retornam o mesmo app.
+    """
+    global ASSINATURA_APLICACAO
+    if 'inventario' in app.extensions and not configuracao:
+        return app
+    with criacao_lock:
+        if 'inventario' in app.extensions:
+            if configuracao:
+                raise RuntimeError('criar_app() já foi chamado: a configuração não pode mais mudar')
+            return app
+        inicio = time.perf_counter()
+        app.config.update(configuracao or {})
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', opcoes_engine(app.config['SQLALCHEMY_DATABASE_URI']))
+        db.init_app(app)
+        login_manager.init_app(app)
+        cache_qr.capacidade = app.config['QR_CACHE_MEMORIA']
+        manifesto_estaticos.update(estaticos.ler_manifesto(app.static_folder))
+        ASSINATURA_APLICACAO = assinatura_aplicacao()
+        duracao = time.perf_counter() - inicio
+        app.extensions['inventario'] = {'inicializacao_segundos': duracao, 'importacao_segundos': DURACAO_IMPORTACAO}
+    metricas.observar('inventario_importacao_segundos', DURACAO_IMPORTACAO, 'Duração do import de app.py no processo.')
+    metricas.observar('inventario_inicializacao_segundos', duracao, 'Duração de criar_app() no processo.')
+    limite = app.config['INICIALIZACAO_LIMITE']
+    # O tempo entre o import e a chamada (ex.: à espera da 1ª requisição) não entra na conta
+    partida = DURACAO_IMPORTACAO + duracao
+    if limite and partida > limite:
+        app.logger.warning('partida levou %.3fs (import %.3fs + criar_app() %.3fs), acima de '
+                           'INICIALIZACAO_LIMITE (%.3fs)', partida, DURACAO_IMPORTACAO, duracao, limite)
+    return app
+
+@appcontext_pushed.connect_via(app)
+def criar_app_sob_demanda(remetente, **extra):
+    # `flask --app app`, `gunicorn app:app` e scripts que só fazem app.app_context()
+    # continuam funcionando: o primeiro contexto completa a criação
+    if 'inventario' not in app.extensions:
+        criar_app()
+
 # ===================================
 # Bloco Principal: Criação do Banco e Execução do App
 # ===================================
+def inicializar_banco():
+    db.create_all()
+    atualizar_esquema()
+    prepopulate_categories()
+    # Criar usuário admin se não existir
+    admin = User.query.filter_by(username='admin').first()
+    if not admin:
+        admin = User(username='admin', is_admin=True, approved=True)
+        admin.set_password('senha123')
+        db.session.add(admin)
+        db.session.commit()
+
+@app.cli.command('inicializar')
+def inicializar_comando():
+    """Cria as tabelas, índices, categorias padrão e o usuário admin."""
+    inicializar_banco()
+    click.echo('Banco de dados inicializado.')
+
+DURACAO_IMPORTACAO = time.perf_counter() - INICIO_IMPORTACAO
+
 if __name__ == '__main__':
+    criar_app()
     with app.app_context():
-        db.create_all()
-        prepopulate_categories()
-        # Criar usuário admin se não existir
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            admin = User(username='admin', is_admin=True, approved=True)
-            admin.set_password('senha123')
-            db.session.add(admin)
-            db.session.commit()
-    app.run(host='0.0.0.0', debug=True)
+        inicializar_banco()
+    # Servidor de desenvolvimento; em produção use o gunicorn (veja gunicorn.conf.py)
+    app.run(host='0.0.0.0', debug=app.config['DEBUG'])
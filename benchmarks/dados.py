@@ -0,0 +1,137 @@
+"""Gera um banco SQLite novo, com volume configurável, para os benchmarks.
+
+Uso (na raiz do projeto):
+    python benchmarks/dados.py /tmp/inventario_bench.db --perfil medio
+    python benchmarks/dados.py /tmp/inventario_bench.db --categorias 50 --materiais 250000 --usuarios 200
+
+O esquema é criado pelo próprio app (inicializar_banco), então índices,
+colunas geradas e gatilhos da busca são os mesmos da produção.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (categorias, materiais, usuários)
+PERFIS = {
+    'pequeno': (20, 1_000, 10),
+    'medio': (100, 100_000, 100),
+    'grande': (500, 1_000_000, 1_000),
+}
+SENHA = 'senha-bench'
+LOTE = 10_000
+
+ITENS = ['Parafuso', 'Porca', 'Arruela', 'Cabo', 'Fio', 'Tinta', 'Lâmpada', 'Tomada', 'Disjuntor',
+         'Cano', 'Joelho', 'Luva', 'Registro', 'Torneira', 'Vassoura', 'Detergente', 'Papel',
+         'Caneta', 'Grampeador', 'Cimento', 'Areia', 'Tijolo', 'Mangueira', 'Cloro', 'Pincel']
+ADJETIVOS = ['elétrico', 'galvanizado', 'sextavado', 'acrílica', 'branca', 'preto', 'flexível',
+             'rígido', 'industrial', 'doméstico', 'reforçado', 'econômico', 'atóxica', 'têxtil']
+MEDIDAS = ['1/2"', '3/4"', '10mm', '25mm', '2,5mm²', '4mm²', '18L', '3,6L', '60W', '9W', '1kg', '50kg']
+
+
+def preparar_app(caminho_banco):
+    """Importa o app apontando para o banco informado (precisa vir antes do import)."""
+    os.environ['INVENTARIO_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(caminho_banco)
+    if RAIZ not in sys.path:
+        sys.path.insert(0, RAIZ)
+    # static/qr_codes é relativo ao diretório atual
+    os.chdir(RAIZ)
+    import app as modulo
+    modulo.criar_app()
+    return modulo
+
+
+def apagar_banco(caminho_banco):
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(caminho_banco + sufixo):
+            os.remove(caminho_banco + sufixo)
+
+
+def em_lotes(gerador, tamanho=LOTE):
+    lote = []
+    for item in gerador:
+        lote.append(item)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def nome_material(rng):
+    return f'{rng.choice(ITENS)} {rng.choice(ADJETIVOS)} {rng.choice(MEDIDAS)}'
+
+
+def linha_material(rng, categorias_ids):
+    alerta_estoque = rng.randint(0, 10)
+    return {
+        'nome': nome_material(rng),
+        'descricao': f'Lote {rng.randint(1, 9999)} - {rng.choice(ADJETIVOS)}',
+        'quantidade': rng.randint(0, 200),
+        'quantidade_alerta_requisicao': alerta_estoque + rng.randint(0, 20),
+        'quantidade_alerta_estoque': alerta_estoque,
+        # Cerca de 5% sem categoria, como na base real
+        'categoria_id': None if rng.random() < 0.05 else rng.choice(categorias_ids),
+    }
+
+
+def gerar_banco(caminho_banco, categorias, materiais, usuarios, semente=42, verbose=True):
+    apagar_banco(caminho_banco)
+    modulo = preparar_app(caminho_banco)
+    rng = random.Random(semente)
+    inicio = time.perf_counter()
+    with modulo.app.app_context():
+        db = modulo.db
+        modulo.inicializar_banco()
+        existentes = db.session.query(modulo.Categoria.id).count()
+        novas = [{'nome': f'Categoria {i:04d}'} for i in range(max(0, categorias - existentes))]
+        if novas:
+            db.session.execute(modulo.Categoria.__table__.insert(), novas)
+        categorias_ids = [linha[0] for linha in db.session.query(modulo.Categoria.id)]
+
+        for lote in em_lotes(linha_material(rng, categorias_ids) for _ in range(materiais)):
+            db.session.execute(modulo.Material.__table__.insert(), lote)
+            db.session.commit()
+
+        # Um único hash para todos: gerar um por usuário levaria minutos
+        senha_hash = modulo.generate_password_hash(SENHA)
+        for lote in em_lotes({'username': f'usuario{i}', 'password_hash': senha_hash,
+                              'is_admin': False, 'approved': True} for i in range(usuarios)):
+            db.session.execute(modulo.User.__table__.insert(), lote)
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+    if verbose:
+        print(f'{caminho_banco}: {len(categorias_ids)} categorias, {materiais} materiais, '
+              f'{usuarios} usuários em {time.perf_counter() - inicio:.1f}s', file=sys.stderr)
+    return modulo
+
+
+def adicionar_argumentos(parser):
+    parser.add_argument('--perfil', choices=sorted(PERFIS), default='pequeno')
+    parser.add_argument('--categorias', type=int, help='sobrescreve o perfil')
+    parser.add_argument('--materiais', type=int, help='sobrescreve o perfil')
+    parser.add_argument('--usuarios', type=int, help='sobrescreve o perfil')
+    parser.add_argument('--semente', type=int, default=42)
+
+
+def volumes(args):
+    categorias, materiais, usuarios = PERFIS[args.perfil]
+    return (args.categorias if args.categorias is not None else categorias,
+            args.materiais if args.materiais is not None else materiais,
+            args.usuarios if args.usuarios is not None else usuarios)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('banco', help='caminho do arquivo SQLite (será recriado)')
+    adicionar_argumentos(parser)
+    args = parser.parse_args()
+    gerar_banco(args.banco, *volumes(args), semente=args.semente)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+"""Benchmark reproduzível das rotas do inventário (roda offline).
+
+Uso (na raiz do projeto):
+    python benchmarks/executar.py --perfil medio --concorrencia 1,8 --saida resultado.json
+    python benchmarks/executar.py --perfil medio --baseline resultado.json
+
+Para cada nível de concorrência, cada cenário roda --requisicoes vezes,
+repartidas entre as threads clientes. Por padrão os clientes usam o
+test client do Flask (sem rede); com --modo http o app sobe num servidor
+WSGI local com threads e os clientes falam HTTP de verdade.
+
+A saída JSON traz p50/p95/p99, média e vazão de cada cenário, e o pico de
+RSS do processo inteiro (inclui a geração do banco e todos os cenários).
+Com --memoria, cada cenário também traz o pico de memória alocada pelo
+Python durante ele (tracemalloc); o rastreamento deixa as requisições mais
+lentas, então não compare latências de execuções com e sem --memoria.
+As tarefas em segundo plano não rodam durante a medição (TAREFAS_EXECUTOR
+= 'externo'): ficam na fila do banco. Com --baseline, os números são comparados aos de uma
+execução anterior e o script termina com código 1 se algum cenário
+piorar além da --tolerancia.
+"""
+import argparse
+import http.cookiejar
+import itertools
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dados  # noqa: E402
+
+# ===================================
+# Clientes: test client do Flask ou HTTP num servidor local
+# ===================================
+
+
+class ClienteFlask:
+    def __init__(self, app):
+        self.cliente = app.test_client()
+
+    # Lê o corpo antes de fechar: nas páginas transmitidas em fluxo o template só
+    # é renderizado enquanto o corpo é consumido, como no cliente HTTP
+    def get(self, url):
+        resposta = self.cliente.get(url)
+        resposta.get_data()
+        resposta.close()
+        return resposta.status_code
+
+    def post(self, url, formulario=None, json_=None):
+        resposta = self.cliente.post(url, data=formulario, json=json_)
+        resposta.get_data()
+        resposta.close()
+        return resposta.status_code
+
+
+class SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ClienteHTTP:
+    def __init__(self, base):
+        self.base = base
+        self.abridor = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), SemRedirecionar())
+
+    def abrir(self, requisicao):
+        try:
+            with self.abridor.open(requisicao, timeout=60) as resposta:
+                resposta.read()
+                return resposta.status
+        except urllib.error.HTTPError as erro:
+            erro.read()
+            return erro.code
+
+    def get(self, url):
+        return self.abrir(urllib.request.Request(self.base + url))
+
+    def post(self, url, formulario=None, json_=None):
+        if json_ is not None:
+            corpo = json.dumps(json_).encode('utf-8')
+            cabecalhos = {'Content-Type': 'application/json'}
+        else:
+            corpo = urllib.parse.urlencode(formulario or {}).encode('utf-8')
+            cabecalhos = {'Content-Type': 'application/x-www-form-urlencoded'}
+        return self.abrir(urllib.request.Request(self.base + url, data=corpo, headers=cabecalhos))
+
+
+def iniciar_servidor(app):
+    from werkzeug.serving import make_server
+    # O log de acesso por requisição distorceria as medidas
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f'http://127.0.0.1:{servidor.server_port}'
+
+# ===================================
+# Cenários
+# ===================================
+
+
+class Contexto:
+    """Estado compartilhado pelos cenários (ids válidos, filas de itens descartáveis)."""
+
+    def __init__(self, modulo, semente):
+        self.modulo = modulo
+        self.semente = semente
+        self.sequencia = itertools.count()
+        self.descartaveis = queue.SimpleQueue()
+        self.categorias_descartaveis = queue.SimpleQueue()
+        with modulo.app.app_context():
+            db = modulo.db
+            self.max_material = db.session.query(db.func.max(modulo.Material.id)).scalar() or 1
+            self.categorias = [linha[0] for linha in db.session.query(modulo.Categoria.id)]
+            self.usuarios = [linha[0] for linha in db.session.query(modulo.User.username)
+                             .filter(modulo.User.username.like('usuario%'))]
+
+    def material_aleatorio(self, rng):
+        # Só a primeira metade: a outra pode ser apagada por cenários de remoção
+        return rng.randint(1, max(1, self.max_material // 2))
+
+
+CENARIOS = {}
+
+
+def cenario(nome, preparar=None):
+    def registrar(funcao):
+        CENARIOS[nome] = (funcao, preparar)
+        return funcao
+    return registrar
+
+
+for _modo in ('todos', 'alfabetica', 'categoria', 'ambos'):
+    cenario(f'listar_{_modo}')(lambda cliente, ctx, rng, modo=_modo: cliente.get(f'/?order={modo}'))
+
+
+@cenario('listar_filtrado')
+def listar_filtrado(cliente, ctx, rng):
+    return cliente.get(f'/?order=ambos&alerta=qualquer&categoria={rng.choice(ctx.categorias)}')
+
+
+@cenario('buscar')
+def buscar(cliente, ctx, rng):
+    termo = rng.choice(dados.ITENS)[:rng.randint(3, 6)]
+    return cliente.get('/buscar?' + urllib.parse.urlencode({'q': termo}))
+
+
+@cenario('alertas')
+def alertas(cliente, ctx, rng):
+    return cliente.get(f'/alertas.json?categoria={rng.choice(ctx.categorias)}')
+
+
+@cenario('adicionar')
+def adicionar(cliente, ctx, rng):
+    return cliente.post('/adicionar', formulario={
+        'nome': dados.nome_material(rng), 'descricao': 'benchmark', 'quantidade': rng.randint(0, 50),
+        'quantidade_alerta_requisicao': 10, 'quantidade_alerta_estoque': 5,
+        'categoria': rng.choice(ctx.categorias),
+    })
+
+
+@cenario('editar')
+def editar(cliente, ctx, rng):
+    return cliente.post(f'/editar/{ctx.material_aleatorio(rng)}', formulario={
+        'nome': dados.nome_material(rng), 'descricao': 'editado', 'quantidade': 10,
+        'quantidade_original': 10, 'quantidade_alerta_requisicao': 8, 'quantidade_alerta_estoque': 3,
+        'categoria': rng.choice(ctx.categorias),
+    })
+
+
+@cenario('movimentar')
+def movimentar(cliente, ctx, rng):
+    return cliente.post(f'/movimentar/{ctx.material_aleatorio(rng)}',
+                        json_={'tipo': 'entrada', 'quantidade': rng.randint(1, 5)})
+
+
+def preparar_remocao(ctx, quantidade, itens_por_categoria):
+    modulo = ctx.modulo
+    with modulo.app.app_context():
+        tabela = modulo.Material.__table__
+        for _ in range(quantidade):
+            resultado = modulo.db.session.execute(tabela.insert().values(nome='descartável', quantidade=0))
+            ctx.descartaveis.put(resultado.inserted_primary_key[0])
+        modulo.db.session.commit()
+
+
+@cenario('remover', preparar=preparar_remocao)
+def remover(cliente, ctx, rng):
+    return cliente.post(f'/remover/{ctx.descartaveis.get_nowait()}')
+
+
+def preparar_remocao_categoria(ctx, quantidade, itens_por_categoria):
+    modulo = ctx.modulo
+    with modulo.app.app_context():
+        db = modulo.db
+        for _ in range(quantidade):
+            resultado = db.session.execute(modulo.Categoria.__table__.insert().values(
+                nome=f'descartável {next(ctx.sequencia)} {time.time_ns()}'))
+            categoria_id = resultado.inserted_primary_key[0]
+            db.session.execute(modulo.Material.__table__.insert(), [
+                {'nome': 'item de categoria descartável', 'quantidade': 1, 'categoria_id': categoria_id}
+                for _ in range(itens_por_categoria)])
+            ctx.categorias_descartaveis.put(categoria_id)
+        db.session.commit()
+
+
+@cenario('remover_categoria', preparar=preparar_remocao_categoria)
+def remover_categoria(cliente, ctx, rng):
+    return cliente.post(f'/categorias/remover/{ctx.categorias_descartaveis.get_nowait()}')
+
+
+@cenario('login')
+def login(cliente, ctx, rng):
+    # Cliente sem sessão a cada vez: um usuário logado é só redirecionado
+    novo = ctx.novo_cliente()
+    return novo.post('/login', formulario={'username': rng.choice(ctx.usuarios), 'password': dados.SENHA})
+
+# ===================================
+# Execução e estatísticas
+# ===================================
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def pico_rss_processo_mb():
+    # ru_maxrss vem em KB no Linux; é o pico desde o início do processo, não do cenário
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def executar_cenario(nome, ctx, requisicoes, concorrencia, itens_por_categoria, memoria=False):
+    funcao, preparar = CENARIOS[nome]
+    if preparar:
+        preparar(ctx, requisicoes, itens_por_categoria)
+    por_thread = [requisicoes // concorrencia + (1 if i < requisicoes % concorrencia else 0)
+                  for i in range(concorrencia)]
+    latencias = [[] for _ in range(concorrencia)]
+    erros = [0] * concorrencia
+    barreira = threading.Barrier(concorrencia + 1)
+
+    def trabalhar(indice):
+        rng = random.Random(f'{ctx.semente}-{nome}-{indice}')
+        cliente = ctx.novo_cliente()
+        status = cliente.post('/login', formulario={'username': ctx.usuarios[indice % len(ctx.usuarios)],
+                                                     'password': dados.SENHA})
+        if status != 302:
+            raise RuntimeError(f'login do cliente de benchmark falhou ({status})')
+        barreira.wait()
+        for _ in range(por_thread[indice]):
+            inicio = time.perf_counter()
+            status = funcao(cliente, ctx, rng)
+            latencias[indice].append(time.perf_counter() - inicio)
+            if status >= 400:
+                erros[indice] += 1
+
+    if memoria:
+        tracemalloc.start()
+    threads = [threading.Thread(target=trabalhar, args=(i,)) for i in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    barreira.wait()
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+    pico = None
+    if memoria:
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    todas = sorted(itertools.chain.from_iterable(latencias))
+    resultado = {
+        'requisicoes': len(todas),
+        'erros': sum(erros),
+        'p50_ms': round(percentil(todas, 50) * 1000, 3),
+        'p95_ms': round(percentil(todas, 95) * 1000, 3),
+        'p99_ms': round(percentil(todas, 99) * 1000, 3),
+        'media_ms': round(sum(todas) / len(todas) * 1000, 3) if todas else 0.0,
+        'vazao_rps': round(len(todas) / duracao, 2) if duracao else 0.0,
+    }
+    if pico is not None:
+        resultado['pico_memoria_mb'] = round(pico / 1024 / 1024, 1)
+    return resultado
+
+
+def comparar(atual, baseline, tolerancia):
+    """Lista (cenário, concorrência, motivo) dos cenários que pioraram."""
+    anteriores = {(e['concorrencia'], nome): r
+                  for e in baseline['execucoes'] for nome, r in e['cenarios'].items()}
+    regressoes = []
+    for execucao in atual['execucoes']:
+        for nome, resultado in execucao['cenarios'].items():
+            anterior = anteriores.get((execucao['concorrencia'], nome))
+            if not anterior:
+                continue
+            if resultado['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia):
+                regressoes.append((nome, execucao['concorrencia'],
+                                   f"p95 {anterior['p95_ms']}ms -> {resultado['p95_ms']}ms"))
+            if resultado['vazao_rps'] < anterior['vazao_rps'] * (1 - tolerancia):
+                regressoes.append((nome, execucao['concorrencia'],
+                                   f"vazão {anterior['vazao_rps']} -> {resultado['vazao_rps']} req/s"))
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--banco', default=os.path.join(tempfile.gettempdir(), 'inventario_bench.db'))
+    parser.add_argument('--reusar', action='store_true', help='não recria o banco se ele já existir')
+    dados.adicionar_argumentos(parser)
+    parser.add_argument('--requisicoes', type=int, default=200, help='por cenário e nível de concorrência')
+    parser.add_argument('--concorrencia', default='1,4', help='níveis separados por vírgula')
+    parser.add_argument('--cenarios', help='lista separada por vírgula (padrão: todos)')
+    parser.add_argument('--modo', choices=['flask', 'http'], default='flask')
+    parser.add_argument('--itens-por-categoria', type=int, default=100,
+                        help='materiais em cada categoria apagada no cenário remover_categoria')
+    parser.add_argument('--saida', help='arquivo JSON de resultado (padrão: stdout)')
+    parser.add_argument('--baseline', help='JSON de uma execução anterior para comparar')
+    parser.add_argument('--tolerancia', type=float, default=0.2)
+    parser.add_argument('--memoria', action='store_true',
+                        help='mede o pico de memória de cada cenário (tracemalloc; deixa tudo mais lento)')
+    args = parser.parse_args()
+
+    categorias, materiais, usuarios = dados.volumes(args)
+    if args.reusar and os.path.exists(args.banco):
+        modulo = dados.preparar_app(args.banco)
+    else:
+        modulo = dados.gerar_banco(args.banco, categorias, materiais, max(usuarios, 1), args.semente)
+    app = modulo.app
+    # Todos os logins vêm do mesmo IP: sem isso o cenário mediria só o 429
+    app.config['LOGIN_LIMITE'] = 0
+    # QR Codes e exportações ficam na fila: threads do executor disputariam CPU e banco com a medição
+    app.config['TAREFAS_EXECUTOR'] = 'externo'
+
+    ctx = Contexto(modulo, args.semente)
+    servidor = None
+    if args.modo == 'http':
+        servidor, base = iniciar_servidor(app)
+        ctx.novo_cliente = lambda: ClienteHTTP(base)
+    else:
+        ctx.novo_cliente = lambda: ClienteFlask(app)
+
+    nomes = args.cenarios.split(',') if args.cenarios else list(CENARIOS)
+    desconhecidos = [nome for nome in nomes if nome not in CENARIOS]
+    if desconhecidos:
+        parser.error(f'cenários desconhecidos: {", ".join(desconhecidos)}')
+
+    resultado = {
+        'data': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'ambiente': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'dados': {'categorias': len(ctx.categorias), 'materiais': ctx.max_material, 'usuarios': len(ctx.usuarios)},
+        'configuracao': {'modo': args.modo, 'requisicoes': args.requisicoes, 'semente': args.semente,
+                         'memoria': args.memoria},
+        'execucoes': [],
+    }
+    for concorrencia in (int(n) for n in args.concorrencia.split(',')):
+        execucao = {'concorrencia': concorrencia, 'cenarios': {}}
+        for nome in nomes:
+            execucao['cenarios'][nome] = executar_cenario(
+                nome, ctx, args.requisicoes, concorrencia, args.itens_por_categoria, args.memoria)
+            r = execucao['cenarios'][nome]
+            print(f'c={concorrencia:<3} {nome:<20} p50={r["p50_ms"]:>9.2f}ms p95={r["p95_ms"]:>9.2f}ms '
+                  f'p99={r["p99_ms"]:>9.2f}ms {r["vazao_rps"]:>9.1f} req/s erros={r["erros"]}',
+                  file=sys.stderr)
+        resultado['execucoes'].append(execucao)
+    resultado['pico_rss_processo_mb'] = round(pico_rss_processo_mb(), 1)
+    if servidor:
+        servidor.shutdown()
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(texto + '\n')
+    else:
+        print(texto)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as arquivo:
+            regressoes = comparar(resultado, json.load(arquivo), args.tolerancia)
+        for nome, concorrencia, motivo in regressoes:
+            print(f'REGRESSÃO {nome} (c={concorrencia}): {motivo}', file=sys.stderr)
+        if regressoes:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
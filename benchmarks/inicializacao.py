@@ -0,0 +1,108 @@
+"""Mede o tempo de partida do app (import + criar_app) em interpretadores novos.
+
+Uso (na raiz do projeto):
+    python benchmarks/inicializacao.py
+    python benchmarks/inicializacao.py --repeticoes 20 --limite 0.8 --detalhar
+
+Cada repetição roda um `python` novo que importa app.py e chama criar_app(),
+como faz cada worker do gunicorn e cada comando do flask. A saída traz a
+mediana e o p95 do import, de criar_app() e do processo inteiro; o script
+termina com código 1 se a mediana do processo passar de --limite segundos
+ou se qrcode/PIL forem carregados na partida. Com --detalhar, lista os
+módulos mais lentos de importar (python -X importtime).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILHO = """
+import json, sys, time
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+app.criar_app()
+fim = time.perf_counter()
+pesados = sorted(m for m in sys.modules if m.split('.')[0] in ('qrcode', 'PIL', 'etiquetas'))
+print(json.dumps({'import': importado - inicio, 'criar_app': fim - importado, 'pesados': pesados}))
+"""
+# Módulos que só devem ser carregados quando um QR Code ou etiqueta é gerado
+PESADOS = ('qrcode', 'PIL', 'etiquetas')
+
+
+def medir_uma_vez():
+    inicio = time.perf_counter()
+    saida = subprocess.run([sys.executable, '-c', FILHO], cwd=RAIZ, capture_output=True, text=True, check=True)
+    total = time.perf_counter() - inicio
+    medida = json.loads(saida.stdout.strip().splitlines()[-1])
+    medida['processo'] = total
+    return medida
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def imports_mais_lentos(quantidade):
+    """(próprio_ms, acumulado_ms, módulo) dos imports mais lentos, pelo tempo próprio."""
+    saida = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                           cwd=RAIZ, capture_output=True, text=True, check=True)
+    linhas = []
+    for linha in saida.stderr.splitlines():
+        if not linha.startswith('import time:') or 'self [us]' in linha:
+            continue
+        proprio, acumulado, modulo = (parte.strip() for parte in linha[len('import time:'):].split('|'))
+        linhas.append((int(proprio) / 1000, int(acumulado) / 1000, modulo))
+    return sorted(linhas, reverse=True)[:quantidade]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeticoes', type=int, default=10)
+    parser.add_argument('--limite', type=float, default=1.0,
+                        help='segundos: mediana máxima do processo inteiro (0 desliga)')
+    parser.add_argument('--detalhar', action='store_true', help='lista os imports mais lentos')
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    args = parser.parse_args()
+
+    # A primeira execução compila os .pyc e não entra na conta
+    medir_uma_vez()
+    medidas = [medir_uma_vez() for _ in range(args.repeticoes)]
+    resultado = {'repeticoes': args.repeticoes, 'limite_s': args.limite, 'python': sys.version.split()[0]}
+    for etapa in ('import', 'criar_app', 'processo'):
+        valores = [medida[etapa] for medida in medidas]
+        resultado[etapa] = {'p50_ms': round(statistics.median(valores) * 1000, 1),
+                            'p95_ms': round(percentil(valores, 95) * 1000, 1)}
+        print(f'{etapa:<10} p50={resultado[etapa]["p50_ms"]:>8.1f}ms p95={resultado[etapa]["p95_ms"]:>8.1f}ms',
+              file=sys.stderr)
+    resultado['pesados'] = sorted({modulo for medida in medidas for modulo in medida['pesados']})
+
+    if args.detalhar:
+        print('\nimports mais lentos (tempo próprio / acumulado):', file=sys.stderr)
+        for proprio, acumulado, modulo in imports_mais_lentos(15):
+            print(f'  {proprio:>8.1f}ms {acumulado:>8.1f}ms  {modulo}', file=sys.stderr)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(json.dumps(resultado, indent=2) + '\n')
+
+    falhas = []
+    if resultado['pesados']:
+        falhas.append(f'carregados na partida: {", ".join(resultado["pesados"])} '
+                      f'(devem ser importados só quando usados)')
+    if args.limite and resultado['processo']['p50_ms'] > args.limite * 1000:
+        falhas.append(f'partida levou {resultado["processo"]["p50_ms"]:.1f}ms (limite {args.limite * 1000:.0f}ms)')
+    for falha in falhas:
+        print(f'ACIMA DO ORÇAMENTO: {falha}', file=sys.stderr)
+    if falhas:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# ===================================
+# Arquivos estáticos: pacotes minificados com o hash do conteúdo no nome
+# ===================================
+#
+# Como etiquetas.py, este módulo não depende do Flask. `flask estaticos`
+# (veja app.py) chama gerar() a cada deploy: os CSS/JS de PACOTES são
+# juntados num arquivo por pacote, os CSS próprios são minificados, as fontes
+# e imagens citadas em url() são copiadas e tudo vai para static/dist com o
+# hash do conteúdo no nome (app.3f2a9c1b0d4e.css). Como o nome muda quando o
+# conteúdo muda, o navegador pode guardar esses arquivos por um ano sem
+# revalidar. As versões .gz e .br ficam prontas ao lado de cada arquivo de
+# texto, então o servidor não comprime nada a cada requisição.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Pacote -> arquivos de origem (relativos a static/), na ordem em que são juntados
+PACOTES = {
+    'css/app.css': [
+        'vendor/bootstrap/bootstrap.min.css',
+        'vendor/roboto/roboto.css',
+        'css/styles.css',
+    ],
+    'js/app.js': [
+        'vendor/bootstrap/popper.min.js',
+        'vendor/bootstrap/bootstrap.min.js',
+    ],
+}
+PASTA_DIST = 'dist'
+MANIFESTO = 'manifest.json'
+COMPRESSIVEIS = ('.css', '.js', '.svg', '.json', '.txt')
+
+# Strings e comentários são reconhecidos antes de mexer nos espaços, para não
+# alterar o conteúdo de '...' e url("data:...")
+TOKENS_CSS = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)''', re.S)
+URL_CSS = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+MAPA_FONTE = re.compile(r'^\s*(/[/*])# sourceMappingURL=.*$', re.M)
+
+
+def compactar_css(trecho):
+    trecho = re.sub(r'\s+', ' ', trecho)
+    trecho = re.sub(r' ?([{};,>]) ?', r'\1', trecho)
+    # Só o espaço depois dos ':' das declarações (propriedade logo após '{' ou ';')
+    trecho = re.sub(r'([{;][\w-]+): ', r'\1:', trecho)
+    return trecho.replace(' !', '!').replace(';}', '}')
+
+
+def minificar_css(texto):
+    """Remove comentários (menos os /*! de licença) e espaços desnecessários."""
+    saida, codigo, posicao = [], [], 0
+    for achado in TOKENS_CSS.finditer(texto):
+        codigo.append(texto[posicao:achado.start()])
+        string, comentario = achado.groups()
+        if string or comentario.startswith('/*!'):
+            saida.append(compactar_css(''.join(codigo)))
+            saida.append(string or comentario + '\n')
+            codigo = []
+        posicao = achado.end()
+    codigo.append(texto[posicao:])
+    saida.append(compactar_css(''.join(codigo)))
+    return ''.join(saida).strip()
+
+
+def nome_com_hash(nome, dados):
+    base, extensao = os.path.splitext(nome)
+    return f'{base}.{hashlib.sha256(dados).hexdigest()[:12]}{extensao}'
+
+
+class Construtor:
+    """Grava os arquivos de uma geração em static/dist e monta o manifesto."""
+
+    def __init__(self, pasta_static):
+        self.pasta_static = pasta_static
+        self.destino = os.path.join(pasta_static, PASTA_DIST)
+        self.manifesto = {}
+
+    def gravar(self, nome, dados):
+        if nome not in self.manifesto:
+            final = nome_com_hash(nome, dados)
+            caminho = os.path.join(self.destino, *final.split('/'))
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            variantes = [('', dados)]
+            if final.endswith(COMPRESSIVEIS):
+                variantes.append(('.gz', gzip.compress(dados, 9, mtime=0)))
+                if brotli is not None:
+                    variantes.append(('.br', brotli.compress(dados, quality=11)))
+            for sufixo, conteudo in variantes:
+                # Mesmo nome = mesmo conteúdo: arquivos de gerações anteriores são reaproveitados
+                if not os.path.exists(caminho + sufixo):
+                    with open(caminho + sufixo, 'wb') as arquivo:
+                        arquivo.write(conteudo)
+            self.manifesto[nome] = final
+        return self.manifesto[nome]
+
+    def ler(self, nome):
+        with open(os.path.join(self.pasta_static, *nome.split('/')), 'rb') as arquivo:
+            return arquivo.read()
+
+    def css(self, pacote, origem):
+        texto = self.ler(origem).decode('utf-8')
+        texto = MAPA_FONTE.sub('', texto)
+        if not origem.endswith('.min.css'):
+            texto = minificar_css(texto)
+        texto = re.sub(r'@charset\s+"[^"]*";', '', texto)
+
+        def reescrever(achado):
+            endereco = achado.group(2).strip()
+            if re.match(r'^(data:|[a-z]+:|/|#)', endereco):
+                return achado.group(0)
+            # ?#iefix e afins seguem no endereço novo
+            caminho, sufixo = re.match(r'([^?#]*)(.*)', endereco).groups()
+            referido = os.path.normpath(os.path.join(os.path.dirname(origem), caminho)).replace(os.sep, '/')
+            final = self.gravar(referido, self.ler(referido))
+            relativo = os.path.relpath(final, os.path.dirname(pacote) or '.').replace(os.sep, '/')
+            return f"url('{relativo}{sufixo}')"
+
+        return URL_CSS.sub(reescrever, texto)
+
+    def pacote(self, pacote, origens):
+        if pacote.endswith('.css'):
+            partes = [self.css(pacote, origem) for origem in origens]
+            # @charset só vale no início do arquivo; os das origens foram removidos
+            return self.gravar(pacote, ('@charset "UTF-8";' + '\n'.join(partes)).encode('utf-8'))
+        partes = [MAPA_FONTE.sub('', self.ler(origem).decode('utf-8')).strip() for origem in origens]
+        # ';' entre os arquivos: um script que termina sem ele não se junta ao próximo
+        return self.gravar(pacote, ';\n'.join(partes).encode('utf-8'))
+
+
+def ler_manifesto(pasta_static):
+    """Retorna {nome lógico: nome com hash}, ou {} se os pacotes nunca foram gerados."""
+    try:
+        with open(os.path.join(pasta_static, PASTA_DIST, MANIFESTO), encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except FileNotFoundError:
+        return {}
+
+
+def gerar(pasta_static, pacotes=None):
+    """Gera os pacotes em static/dist e retorna o manifesto novo.
+
+    Os arquivos da geração anterior são mantidos (workers ainda não
+    reiniciados continuam apontando para eles); os mais antigos são apagados.
+    """
+    anterior = ler_manifesto(pasta_static)
+    construtor = Construtor(pasta_static)
+    for pacote, origens in (pacotes or PACOTES).items():
+        construtor.pacote(pacote, origens)
+    manifesto = construtor.manifesto
+    caminho = os.path.join(construtor.destino, MANIFESTO)
+    temporario = f'{caminho}.{os.getpid()}.tmp'
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump(manifesto, arquivo, indent=2, sort_keys=True)
+    os.replace(temporario, caminho)
+
+    manter = {MANIFESTO} | set(manifesto.values()) | set(anterior.values())
+    for raiz, _, arquivos in os.walk(construtor.destino):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            relativo = os.path.relpath(caminho, construtor.destino).replace(os.sep, '/')
+            if re.sub(r'\.(gz|br)$', '', relativo) not in manter:
+                os.remove(caminho)
+    return manifesto
@@ -0,0 +1,209 @@
+# ===================================
+# Folhas de etiquetas com QR Code
+# ===================================
+#
+# Este módulo não depende do Flask nem do banco: as funções rodam nos
+# processos do pool (veja paginas_etiquetas em app.py), que só precisam
+# importar qrcode e PIL. Cada processo desenha uma página inteira e devolve
+# os bytes já comprimidos; o processo principal só costura as páginas no PDF
+# (ou no ZIP de PNGs) e as envia assim que ficam prontas.
+
+import io
+import zipfile
+import zlib
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+# Folha A4 com 3 x 8 etiquetas (padrão das folhas adesivas 70 x 37 mm)
+LAYOUT_PADRAO = {
+    'dpi': 200,
+    'largura_mm': 210,
+    'altura_mm': 297,
+    'colunas': 3,
+    'linhas': 8,
+    'margem_mm': 8,
+}
+
+
+def mm_para_px(mm, dpi):
+    return int(round(mm / 25.4 * dpi))
+
+
+def carregar_fonte(tamanho):
+    try:
+        return ImageFont.load_default(size=tamanho)
+    except TypeError:
+        # Pillow < 10.1 só tem a fonte bitmap pequena
+        return ImageFont.load_default()
+
+
+def quebrar_texto(desenho, texto, fonte, largura, max_linhas):
+    linhas, atual = [], ''
+    for palavra in texto.split():
+        candidata = f'{atual} {palavra}'.strip()
+        if desenho.textlength(candidata, font=fonte) <= largura or not atual:
+            atual = candidata
+        else:
+            linhas.append(atual)
+            atual = palavra
+    if atual:
+        linhas.append(atual)
+    if len(linhas) > max_linhas:
+        linhas = linhas[:max_linhas]
+        linhas[-1] = linhas[-1][:max(1, len(linhas[-1]) - 1)] + '…'
+    return linhas
+
+
+def matriz_qr(conteudo, lado_px):
+    # Máscara fixa: a busca pela melhor máscara (8 tentativas) dominava o tempo da página
+    qr = qrcode.QRCode(border=0, error_correction=qrcode.constants.ERROR_CORRECT_M, mask_pattern=0)
+    qr.add_data(conteudo)
+    qr.make(fit=True)
+    matriz = qr.get_matrix()
+    modulos = len(matriz)
+    imagem = Image.new('1', (modulos, modulos))
+    imagem.putdata([0 if escuro else 255 for linha in matriz for escuro in linha])
+    # Ampliação por vizinho mais próximo: módulos nítidos, sem borrar na impressão
+    escala = max(1, lado_px // modulos)
+    return imagem.resize((modulos * escala, modulos * escala), Image.NEAREST)
+
+
+def renderizar_pagina(itens, url_base, formato='pdf', layout=None):
+    """Desenha uma página de etiquetas; `itens` é uma lista de (id, nome).
+
+    Retorna (largura, altura, bytes): PNG quando formato == 'png', ou os
+    pixels de 1 bit comprimidos com zlib, prontos para o PDF.
+    """
+    layout = dict(LAYOUT_PADRAO, **(layout or {}))
+    dpi = layout['dpi']
+    largura = mm_para_px(layout['largura_mm'], dpi)
+    altura = mm_para_px(layout['altura_mm'], dpi)
+    margem = mm_para_px(layout['margem_mm'], dpi)
+    celula_l = (largura - 2 * margem) // layout['colunas']
+    celula_a = (altura - 2 * margem) // layout['linhas']
+    respiro = celula_a // 12
+    lado_qr = celula_a - 2 * respiro
+    fonte_nome = carregar_fonte(max(10, celula_a // 9))
+    fonte_id = carregar_fonte(max(10, celula_a // 7))
+
+    pagina = Image.new('1', (largura, altura), 255)
+    desenho = ImageDraw.Draw(pagina)
+    for posicao, (material_id, nome) in enumerate(itens):
+        linha, coluna = divmod(posicao, layout['colunas'])
+        x = margem + coluna * celula_l
+        y = margem + linha * celula_a
+        qr = matriz_qr(f'{url_base}/editar/{material_id}', lado_qr)
+        pagina.paste(qr, (x + respiro, y + (celula_a - qr.height) // 2))
+        texto_x = x + 2 * respiro + qr.width
+        largura_texto = celula_l - (texto_x - x) - respiro
+        desenho.text((texto_x, y + respiro), f'ID {material_id}', font=fonte_id, fill=0)
+        topo = y + respiro + fonte_id.size + respiro
+        for texto in quebrar_texto(desenho, nome or '', fonte_nome, largura_texto, 4):
+            desenho.text((texto_x, topo), texto, font=fonte_nome, fill=0)
+            topo += int(fonte_nome.size * 1.2)
+
+    if formato == 'png':
+        buffer = io.BytesIO()
+        pagina.save(buffer, format='PNG', optimize=False, dpi=(dpi, dpi))
+        return largura, altura, buffer.getvalue()
+    # Modo '1' já vem com 1 bit por pixel e linhas completadas até o byte, como o PDF espera
+    return largura, altura, zlib.compress(pagina.tobytes(), 6)
+
+
+class EscritorPDF:
+    """Monta um PDF página a página, sem guardar as páginas anteriores.
+
+    Os objetos 1 (catálogo) e 2 (árvore de páginas) são escritos no final,
+    quando já se sabe quantas páginas existem; a tabela xref aceita
+    objetos fora de ordem no arquivo.
+    """
+
+    def __init__(self, largura_mm=210, altura_mm=297):
+        self.largura_pt = largura_mm / 25.4 * 72
+        self.altura_pt = altura_mm / 25.4 * 72
+        self.posicao = 0
+        self.deslocamentos = {}
+        self.paginas = []
+        self.proximo_objeto = 3
+
+    def emitir(self, dados):
+        self.posicao += len(dados)
+        return dados
+
+    def objeto(self, numero, corpo, fluxo=None):
+        self.deslocamentos[numero] = self.posicao
+        dados = f'{numero} 0 obj\n'.encode('ascii') + corpo
+        if fluxo is not None:
+            dados += b'\nstream\n' + fluxo + b'\nendstream'
+        return self.emitir(dados + b'\nendobj\n')
+
+    def cabecalho(self):
+        return self.emitir(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def pagina(self, largura_px, altura_px, pixels_zlib):
+        imagem, conteudo, pagina = range(self.proximo_objeto, self.proximo_objeto + 3)
+        self.proximo_objeto += 3
+        self.paginas.append(pagina)
+        desenho = f'q {self.largura_pt:.2f} 0 0 {self.altura_pt:.2f} 0 0 cm /Im0 Do Q'.encode('ascii')
+        return b''.join([
+            self.objeto(imagem, (
+                f'<< /Type /XObject /Subtype /Image /Width {largura_px} /Height {altura_px} '
+                f'/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode '
+                f'/Length {len(pixels_zlib)} >>').encode('ascii'), pixels_zlib),
+            self.objeto(conteudo, f'<< /Length {len(desenho)} >>'.encode('ascii'), desenho),
+            self.objeto(pagina, (
+                f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.largura_pt:.2f} {self.altura_pt:.2f}] '
+                f'/Resources << /XObject << /Im0 {imagem} 0 R >> >> /Contents {conteudo} 0 R >>'
+            ).encode('ascii')),
+        ])
+
+    def finalizar(self):
+        filhos = ' '.join(f'{numero} 0 R' for numero in self.paginas)
+        dados = self.objeto(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        dados += self.objeto(2, f'<< /Type /Pages /Kids [{filhos}] /Count {len(self.paginas)} >>'.encode('ascii'))
+        inicio_xref = self.posicao
+        total = self.proximo_objeto
+        xref = [f'xref\n0 {total}\n', '0000000000 65535 f \n']
+        xref += [f'{self.deslocamentos[numero]:010d} 00000 n \n' for numero in range(1, total)]
+        xref.append(f'trailer\n<< /Size {total} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n')
+        return dados + self.emitir(''.join(xref).encode('ascii'))
+
+
+class SaidaZip(io.RawIOBase):
+    """Destino não pesquisável para o zipfile: acumula bytes até serem drenados."""
+
+    def __init__(self):
+        self.pendente = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self.pendente += dados
+        return len(dados)
+
+    def drenar(self):
+        dados = bytes(self.pendente)
+        self.pendente.clear()
+        return dados
+
+
+def montar_pdf(paginas, layout=None):
+    """Gera os bytes do PDF conforme as páginas (largura, altura, pixels) chegam."""
+    layout = dict(LAYOUT_PADRAO, **(layout or {}))
+    escritor = EscritorPDF(layout['largura_mm'], layout['altura_mm'])
+    yield escritor.cabecalho()
+    for largura, altura, pixels in paginas:
+        yield escritor.pagina(largura, altura, pixels)
+    yield escritor.finalizar()
+
+
+def montar_zip(paginas):
+    """Gera um ZIP com um PNG por página, em fluxo."""
+    saida = SaidaZip()
+    with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_STORED) as arquivo:
+        for numero, (_, _, png) in enumerate(paginas, start=1):
+            arquivo.writestr(f'etiquetas_{numero:04d}.png', png)
+            yield saida.drenar()
+    yield saida.drenar()
@@ -0,0 +1,66 @@
+# ===================================
+# Implantação com vários processos (gunicorn)
+# ===================================
+#
+# 1. Crie/atualize o banco uma única vez, antes de subir os workers:
+#        flask --app app inicializar
+# 2. Gere os pacotes CSS/JS com hash no nome (a cada deploy que mexa em static/):
+#        flask --app app estaticos
+# 3. Suba o servidor:
+#        gunicorn -c gunicorn.conf.py 'app:criar_app()'
+#
+# Cada worker só importa o módulo e chama criar_app(); qrcode e PIL são
+# carregados no primeiro QR Code/etiqueta. Para conferir o tempo de partida:
+#        python benchmarks/inicializacao.py
+#
+# O SQLite fica em modo WAL (veja SQLITE_PRAGMAS em app.py): vários workers
+# leem ao mesmo tempo e um escreve por vez; quem chega durante uma escrita
+# espera até busy_timeout em vez de falhar, e as rotas de escrita repetem a
+# transação (com_retentativa) se o lock ainda assim não vier.
+#
+# Regras para não corromper nem travar o banco:
+# - O arquivo do banco precisa estar em disco local (WAL não funciona em
+#   compartilhamento de rede/SMB).
+# - Todos os workers na mesma máquina; para vários servidores use outro banco.
+# - Cada worker abre as próprias conexões depois do fork (preload_app = False).
+#   Se precisar de preload_app = True, descarte o pool herdado em post_fork.
+#
+# Tarefas em segundo plano (QR Codes, exportações, limpeza de arquivos): por
+# padrão cada worker consome a fila em threads próprias; ociosos, eles só
+# leem a fila, sem escrever no banco. Com muitos workers, ou para tirar as
+# tarefas dos workers web, use INVENTARIO_TAREFAS_EXECUTOR=externo e rode um
+# único trabalhador à parte:
+#        flask --app app trabalhador
+#
+# Métricas (/metrics) ficam na memória de cada worker e saem com o rótulo
+# worker="<pid>". Cada coleta do Prometheus cai num worker só, então some
+# as séries ignorando o rótulo, ex.:
+#        sum without (worker) (rate(inventario_requisicoes_total[5m]))
+# Um worker reiniciado recomeça do zero com outro pid (rate() lida com isso).
+# Para ver todos os workers em toda coleta, suba um worker por porta
+# (INVENTARIO_WORKERS=1) e colete cada porta.
+#
+# O banco pode ser apontado para outro caminho sem editar o código:
+#        INVENTARIO_SQLALCHEMY_DATABASE_URI=sqlite:////dados/inventario.db
+
+import multiprocessing
+import os
+
+bind = os.environ.get('INVENTARIO_BIND', '0.0.0.0:8000')
+# Processos ajudam nas leituras; as escritas continuam serializadas pelo SQLite
+workers = int(os.environ.get('INVENTARIO_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Threads por worker: as conexões vêm do pool (SQLITE_POOL_SIZE por processo)
+threads = int(os.environ.get('INVENTARIO_THREADS', 4))
+worker_class = 'gthread'
+preload_app = False
+timeout = 60
+graceful_timeout = 30
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Só tem efeito com preload_app = True: conexões abertas no processo pai
+    # não podem ser usadas pelos filhos
+    from app import criar_app, db
+    with criar_app().app_context():
+        db.engine.dispose(close=False)
@@ -3,9 +3,12 @@ REM Ativa o ambiente virtual
 call venv\Scripts\activate.bat
 
 REM Define as variáveis de ambiente para o Flask
-set FLASK_APP=app.py
+set FLASK_APP=app:criar_app()
 set FLASK_ENV=development
 
+REM Gera os pacotes CSS/JS com hash no nome (static/dist)
+python -m flask estaticos
+
 REM Inicia o servidor Flask usando o interpretador Python
 python -m flask run
 